@@ -33,27 +33,24 @@ This is the etcd interface.
 
 import aio_etcd as etcd
 from aio_etcd.client import Client
+from etcd import EtcdResult
 import asyncio
 import weakref
 import inspect
+import json
 from contextlib import suppress
-from itertools import chain
+from itertools import chain, count
+from collections import deque, OrderedDict
+import heapq
 
-from .node import EtcRoot
+from .node import EtcRoot, _types_changed, _types_pattern
+from .util import import_string
+from . import node as _node
 
 __all__ = ("EtcClient","EtcTypes")
 
-# Requiring a lock is bad for our health.
-
-if not hasattr(asyncio.Condition,'notify_unlocked'):
-	def notify_unlocked(self):
-		for fut in self._waiters:
-			if not fut.done():
-				fut.set_result(False)
-asyncio.Condition.notify_unlocked = notify_unlocked
-del notify_unlocked
-
 class _NOTGIVEN: pass
+_wait_seq = count() # tie-breaker for EtcWatcher._waiters
 
 class WatchStopped(RuntimeError):
 	"""Raised when calling sync() on a stopped EtcWatcher."""
@@ -84,8 +81,32 @@ class EtcClient(object):
 		self._loop = loop if loop is not None else asyncio.get_event_loop()
 		self.client = Client(loop=loop, **args)
 		self._trees = set()
+		self._watches = {} # prefix => _SharedWatch
 #		self.watched = weakref.WeakValueDictionary()
 
+	def _watch(self, w):
+		"""\
+			Attach an EtcWatcher to a shared watch which covers its key.
+			If there is none, start one, taking over those for keys below.
+			"""
+		key = w.extkey
+		for sw in self._watches.values():
+			if sw.covers(key):
+				sw.attach(w)
+				return sw
+		sw = _SharedWatch(self, key, w.last_read)
+		for k,osw in list(self._watches.items()):
+			if sw.covers(k):
+				del self._watches[k]
+				for ow in osw.watchers:
+					ow._shared = sw
+					sw.attach(ow)
+				osw.watchers = set()
+				osw.stop()
+		self._watches[key] = sw
+		sw.attach(w)
+		return sw
+
 	async def start(self):
 		if self.last_mod is not None: # pragma: no cover
 			return
@@ -206,7 +227,7 @@ class EtcClient(object):
 		self.last_mod = res.modifiedIndex
 		return res
 
-	async def tree(self, key, sub=_NOTGIVEN, _prefix=False, root_cls=None, types=None, immediate=True, static=False, create=None, **kw):
+	async def tree(self, key, sub=_NOTGIVEN, _prefix=False, root_cls=None, types=None, immediate=True, static=False, create=None, concurrency=None, snapshot=None, **kw):
 		"""\
 			Generate an object tree, populate it, and update it.
 			if @create is True, create the directory node.
@@ -216,6 +237,13 @@ class EtcClient(object):
 			If @immediate is set, run a recursive query and grab everything now.
 			Otherwise fill the tree in the background.
 			@static=True turns off the tree's auto-update.
+			@concurrency: if set, up to this many sibling subdirectories
+			are read in parallel while building the tree.
+			@snapshot: a file name or file-like object written by
+			`EtcRoot.snapshot()`. If given, the tree is built from it and
+			the watcher resumes at the saved index. A full read is done
+			only if the file doesn't exist or etcd has forgotten the
+			events since then.
 
 			*Warning*: If you update the tree by direct assignment, you
 			must call its `wait()` coroutine before you can depend on them 
@@ -234,23 +262,35 @@ class EtcClient(object):
 		else:
 			rec = None
 
-		if create is False:
-			res = await retry_conn(self.client.read,xkey, recursive=rec)
-		elif create is True:
-			res = await retry_conn(self.client.write,xkey, prevExist=False, dir=True, value=None)
-		else:
-			# etcd can't do "create-directory-if-it-does-not-exist", so
-			# if two jobs with create=None attempt this at the same time
-			# the whole thing gets interesting.
-			try:
+		res = None
+		floors = None
+		if snapshot is not None:
+			assert sub is _NOTGIVEN and create is not True
+			res = await self._from_snapshot(snapshot, xkey)
+			if res is not None:
+				res,floors = res
+				rec = True
+		if res is None:
+			if create is False:
 				res = await retry_conn(self.client.read,xkey, recursive=rec)
-			except etcd.EtcdKeyNotFound:
+			elif create is True:
+				res = await retry_conn(self.client.write,xkey, prevExist=False, dir=True, value=None)
+			else:
+				# etcd can't do "create-directory-if-it-does-not-exist", so
+				# if two jobs with create=None attempt this at the same time
+				# the whole thing gets interesting.
 				try:
-					res = await retry_conn(self.client.write,xkey, prevExist=False, dir=True, value=None)
-				except etcd.EtcdAlreadyExist: # pragma: no cover
 					res = await retry_conn(self.client.read,xkey, recursive=rec)
+				except etcd.EtcdKeyNotFound:
+					try:
+						res = await retry_conn(self.client.write,xkey, prevExist=False, dir=True, value=None)
+					except etcd.EtcdAlreadyExist: # pragma: no cover
+						res = await retry_conn(self.client.read,xkey, recursive=rec)
 
 		w = None if static else EtcWatcher(self,xkey,seq=res.etcd_index)
+		if w is not None and floors:
+			for k,i in floors.items():
+				w._add_floor(k,i)
 		if root_cls is None and types is not None:
 			root_cls = types.type[True]
 		if root_cls is None or sub is not _NOTGIVEN:
@@ -259,8 +299,9 @@ class EtcClient(object):
 			if isinstance(root_cls,str):
 				root_cls = import_string(root_cls)
 			assert issubclass(root_cls,EtcRoot)
+		limit = None if not concurrency else asyncio.Semaphore(concurrency, loop=self._loop)
 		root = await root_cls._new(conn=self, watcher=w, key=key, pre=res,
-				recursive=rec, types=types, **kw)
+				recursive=rec, types=types, limit=limit, **kw)
 
 		if w is not None:
 			w._set_root(root)
@@ -268,12 +309,69 @@ class EtcClient(object):
 		if sub is _NOTGIVEN:
 			return root
 
-		r = await root.subdir(*sub,create=create)
+		r = await root.subdir(*sub,create=create, concurrency=concurrency)
 		# re-attach the watcher to the new root
 		if w is not None:
 			w._set_root(r)
 		return root,r
 
+	async def _from_snapshot(self, snapshot, xkey):
+		"""\
+			Load a snapshot written by `EtcRoot.snapshot()`.
+			Returns a (result,floors) tuple, or None if it can't be used.
+
+			A file is read by a worker thread; a file-like object is read
+			in the event loop.
+			"""
+		if isinstance(snapshot,str):
+			def read():
+				with open(snapshot) as f:
+					return json.load(f)
+			try:
+				data = await self._loop.run_in_executor(None, read)
+			except FileNotFoundError:
+				return None
+		else:
+			data = json.load(snapshot)
+		if data['key'] != xkey:
+			raise ValueError("Snapshot is for %s, not %s" % (data['key'],xkey))
+		index = data['index']
+
+		# etcd only remembers the last _HISTORY events. Within that window
+		# we can resume directly, otherwise ask etcd about it.
+		try:
+			res = await retry_conn(self.client.read,xkey)
+		except etcd.EtcdKeyNotFound:
+			return None
+		if res.etcd_index-index >= _HISTORY:
+			try:
+				await asyncio.wait_for(self.client.read(xkey, wait=True,
+					waitIndex=index+1, recursive=True), 1, loop=self._loop)
+			except asyncio.TimeoutError:
+				pass
+			except etcd.EtcdEventIndexCleared:
+				logger.info("Snapshot of %s at %d is too old", xkey,index)
+				return None
+
+		res = EtcdResult(None, _snapshot_node(xkey, data['tree']))
+		res.etcd_index = index
+		return res, data.get('floors',None)
+
+_HISTORY = 1000
+
+def _snapshot_node(key, data):
+	"""Convert a snapshot entry back to etcd's JSON form"""
+	name,cseq,seq,ttl,value = data
+	node = {'key':key, 'createdIndex':cseq, 'modifiedIndex':seq}
+	if ttl is not None:
+		node['ttl'] = ttl
+	if isinstance(value,list):
+		node['dir'] = True
+		node['nodes'] = [_snapshot_node(key+'/'+v[0], v) for v in value]
+	else:
+		node['value'] = value
+	return node
+
 # Helpers for constructing a self-typed sub-tree from a recursive sub(?)-listing
 
 async def build_typed(node,name,cls,t,rec):
@@ -286,6 +384,111 @@ async def build_typed(node,name,cls,t,rec):
 class SkipAhead(BaseException):
 	pass
 
+class _SharedWatch(object):
+	"""\
+		A recursive etcd watch on @key, whose events are fanned out to all
+		EtcWatchers at or below that key.
+
+		The watch runs from the oldest position of its watchers; each of
+		them ignores events it has already seen.
+		"""
+	_reader = None
+
+	def __init__(self, conn, key, seq):
+		self.conn = conn
+		self.key = key
+		self.last_read = seq
+		self.watchers = set()
+
+	def covers(self, key):
+		return key == self.key or key.startswith(self.key+'/')
+
+	def attach(self, w):
+		self.watchers.add(w)
+		if self._reader is None or w.last_read < self.last_read:
+			self.last_read = min(self.last_read, w.last_read)
+			self._start()
+
+	def detach(self, w):
+		"""\
+			Remove a watcher. Returns the reader task if that stopped it.
+			"""
+		self.watchers.discard(w)
+		if self.watchers:
+			return None
+		if self.conn._watches.get(self.key,None) is self:
+			del self.conn._watches[self.key]
+		return self.stop()
+
+	def _start(self):
+		if self._reader is not None:
+			self._reader.cancel()
+		self._reader = asyncio.ensure_future(self._watch_read(), loop=self.conn._loop)
+
+	def stop(self):
+		r,self._reader = self._reader,None
+		if r is not None:
+			try:
+				r.cancel()
+			except RuntimeError: # pragma: no cover ## event loop might be closed
+				pass
+		return r
+
+	def _event(self, x):
+		logger.debug("IN: %s %s",id(self),repr(x.__dict__))
+		if not self.watchers:
+			raise etcd.StopWatching
+		for w in list(self.watchers):
+			w._event(x)
+		self.last_read = x.modifiedIndex
+
+	async def _watch_read(self):
+		"""\
+			Task which reads from etcd and distributes the events received.
+			"""
+		logger.debug("READER started")
+		conn = Client(loop=self.conn._loop, **self.conn.args)
+		try:
+			while self.watchers:
+				logger.debug("INW: %s after %s",id(self),self.last_read)
+				try:
+					await conn.eternal_watch(self.key, index=self.last_read+1, recursive=True, callback=self._event)
+				except etcd.EtcdEventIndexCleared:
+					# Whoever is that far behind needs to re-read its tree.
+					idx = self.last_read
+					for w in list(self.watchers):
+						if w.last_read > idx:
+							continue
+						logger.warning("Watcher for %s lost events after %d, re-reading", w.extkey, w.last_read)
+						try:
+							res = await conn.read(w.extkey, recursive=True)
+						except etcd.EtcdKeyNotFound as e:
+							# its root is gone; the others may continue
+							w.stop(e, "Tree vanished while resyncing")
+							continue
+						w.last_read = res.etcd_index
+						w._queue(res)
+					if self.watchers:
+						self.last_read = min(w.last_read for w in self.watchers)
+
+		except GeneratorExit: # pragma: no cover
+			logger.debug("READER GenEx: %s",id(self))
+			raise
+		except asyncio.CancelledError:
+			logger.debug("READER cancelled: %s", id(self))
+			raise
+		except BaseException as e: # pragma: no cover
+			if type(e) is not RuntimeError or "Event loop is closed" not in str(e):
+				logger.exception("READER died: %s", id(self))
+			for w in list(self.watchers):
+				if not w.stopped.done():
+					w.stopped.set_exception(e)
+			raise
+		else:
+			logger.debug("READER ended: %s", id(self))
+		finally:
+			conn.close()
+
 class EtcWatcher(object):
 	"""\
 		Runs a watcher on a (sub)tree.
@@ -293,32 +496,63 @@ class EtcWatcher(object):
 		@conn: the EtcClient to monitor.
 		@key: the path to monitor, relative to conn.
 		@seq: etcd_index to start monitoring from.
+
+		Watchers of one EtcClient share a single etcd watch per covering
+		prefix, see EtcClient._watch().
+
+		Incoming events are queued and applied in batches of up to
+		`max_batch` events by a single task; waiters are woken up
+		once per batch.
+
+		Up to `cache_size` nodes are remembered by their etcd key, so
+		that events for frequently-updated keys don't need to walk the
+		tree. Nodes drop out of that cache when they're deleted or thrown
+		away.
 		"""
-	_reader = None
+	_shared = None
 	_writer = None
+	_writing = False
 	root = None
+	max_batch = 1000
+	cache_size = 1000
+
 	def __init__(self, conn,key,seq=0, types=None):
 		self.conn = conn
 		self.extkey = key
 		self.last_read = seq
 		self.last_seen = seq
+		self.last_applied = seq # advances per event, last_seen per batch
+		self._pending = deque()
+		self._lock = asyncio.Lock(loop=conn._loop) # vs. _write_local()
+		self._floors = {} # etcd key => index its subtree was read at
+		self._nodes = OrderedDict() # etcd key => weakref to node
 
 		self.q = asyncio.Queue(loop=conn._loop)
-		self.uptodate = asyncio.Condition(loop=conn._loop)
-		self._reader = asyncio.ensure_future(self._watch_read(), loop=conn._loop)
+		self._waiters = [] # heap of (modifiedIndex,n,future), see sync()
 		self.stopped = asyncio.Future(loop=conn._loop)
-		self.stopped.add_done_callback(lambda _: self.uptodate.notify_unlocked())
+		self.stopped.add_done_callback(lambda _: self._wake(all=True))
+		self._shared = conn._watch(self)
 		self.conn._trees.add(self)
 
+	def _add_floor(self, key, index):
+		"""\
+			The subtree at @key has been read at etcd index @index;
+			don't apply older events to it.
+			"""
+		if index > self.last_applied and self._floors.get(key,0) < index:
+			self._floors[key] = index
+
+	def _detach(self):
+		sw,self._shared = self._shared,None
+		if sw is not None:
+			return sw.detach(self)
+
 	def stop(self, exc,cause):
 		if not self.stopped.done():
 			err = WatchError(cause)
 			err.__cause__ = exc
 			self.stopped.set_exception(err)
-		try:
-			self._reader.cancel()
-		except Exception:
-			pass
+		self._detach()
 
 	@property
 	def running(self):
@@ -335,29 +569,37 @@ class EtcWatcher(object):
 				self.stopped.set_result("_kill")
 			except RuntimeError: # pragma: no cover ## event loop might be closed
 				pass
-
-		r,self._reader = self._reader,None
-		if r is not None:
-			try:
-				r.cancel()
-			except RuntimeError: # pragma: no cover ## event loop might be closed
-				pass
+		self._detach()
 
 	async def close(self):
 		self.conn._trees.remove(self)
 		if not self.stopped.done():
 			self.stopped.set_result("close")
-			r,self._reader = self._reader,None
+			r = self._detach()
 			if r is not None:
-				r.cancel()
 				try:
 					await r
 				except asyncio.CancelledError: # pragma: no cover
 					pass
 
+	def _event(self, x):
+		"""Called by the shared watch with each event"""
+		if self.stopped.done():
+			self._detach()
+			return
+		if x.modifiedIndex <= self.last_read:
+			return # another watcher is catching up
+		if x.key != self.extkey and not x.key.startswith(self.extkey+'/'):
+			return
+		self.last_read = x.modifiedIndex
+		self._queue(x)
+
 	def _set_root(self, root):
 		self.root = weakref.ref(root)
 		self.extkey = self.conn._extkey(root.path)
+		if self._pending and not self._writing:
+			self._writing = True
+			root.task(self._write_batch, _die=True, _lane='watch')
 
 	async def sync(self, mod=None, force=False):
 		"""Wait for pending updates"""
@@ -376,73 +618,178 @@ class EtcWatcher(object):
 		if force:
 			mod = max(mod, self.last_read, self.last_seen, self.conn.last_mod)
 		more = False
-		if self._reader is not None and self.last_seen < mod:
-			w = None
-			async with self.uptodate:
-				while self._reader is not None and self.last_seen < mod:
-					logger.debug("Syncing, wait for %d")
-					if self.stopped.done():
-						raise WatchStopped() from self.stopped.exception()
-					await self.uptodate.wait()
-					if force:
-						mod = max(mod, self.last_read, self.last_seen, self.conn.last_mod)
-					more = True
+		if self._shared is not None and self.last_seen < mod:
+			while self._shared is not None and self.last_seen < mod:
+				logger.debug("Syncing, wait for %d",mod)
+				if self.stopped.done():
+					raise WatchStopped() from self.stopped.exception()
+				f = asyncio.Future(loop=self.conn._loop)
+				heapq.heappush(self._waiters, (mod,next(_wait_seq),f))
+				await f
+				if force:
+					mod = max(mod, self.last_read, self.last_seen, self.conn.last_mod)
+				more = True
 			logger.debug("Syncing, done, at %d: %s",self.last_seen, id(self))
 		if self.stopped.done():
 			raise WatchStopped() from self.stopped.exception()
 		return more
 
-	async def _watch_read(self): # pragma: no cover
+	def _wake(self, all=False):
+		"""Release the sync() calls which last_seen has caught up with"""
+		w = self._waiters
+		while w and (all or w[0][0] <= self.last_seen):
+			f = heapq.heappop(w)[2]
+			if not f.done():
+				f.set_result(None)
+
+	def _queue(self, x):
+		"""Queue an event, or a recursive read (for resyncing)"""
+		self._pending.append(x)
+		if not self._writing and self.root is not None:
+			r = self.root()
+			if r is not None:
+				self._writing = True
+				r.task(self._write_batch, _die=True, _lane='watch')
+
+	async def _write_batch(self):
 		"""\
-			Task which reads from etcd and processes the events received.
+			Task which applies queued events, in order
 			"""
-		logger.debug("READER started")
-		conn = Client(loop=self.conn._loop, **self.conn.args)
-
-		key = self.extkey
-		# Initially, if creating a sub-tree, the watcher is attached to
-		# the main tree until looking up / creating the intermediate nodes
-		# is completed. Thus we need to restart watching at the subtree.
+		seen = None
+		n = self.max_batch
 		try:
-			def cb(x):
-				logger.debug("IN: %s %s",id(self),repr(x.__dict__))
-				if self.root is None or self.stopped.done():
-					raise etcd.StopWatching
-				if x.modifiedIndex <= self.last_read:
-					raise RuntimeError("not in sequence: %s %s",self.last_read,x.modifiedIndex)
-				self.last_read = x.modifiedIndex
-				r = self.root()
-				if r is not None:
-					r.task(self._write,x, _die=True)
-
-			while not self.stopped.done():
-				logger.debug("INW: %s after %s",id(self),self.last_read)
-				await conn.eternal_watch(key, index=self.last_read+1, recursive=True, callback=cb)
-				# restart at the subtree
-				key = self.extkey
+			while self._pending and n:
+				x = self._pending.popleft()
+				if x.action == 'get':
+					async with self._lock:
+						ok = await self._resync(x)
+					idx = x.etcd_index
+					if ok:
+						self.last_applied = idx
+				else:
+					async with self._lock:
+						ok = await self._write(x)
+					idx = x.modifiedIndex
+					if ok:
+						self.last_applied = idx
+						await self._notify(x)
+				if not ok:
+					self._pending.clear()
+					break
+				seen = idx
+				n -= 1
+			if seen is not None:
+				self.last_seen = seen
+				self._wake()
+				logger.debug("DONE %d: %s",seen,id(self))
+		finally:
+			# Don't hog the root's task runner: continue in a new task
+			r = self.root() if self.root is not None else None
+			if r is not None:
+				r = r.root # may be a subdir
+			if self._pending and r is not None and not r.closed:
+				r.task(self._write_batch, _die=True, _lane='watch')
+			else:
+				self._writing = False
+
+	async def _notify(self, x):
+		"""Pass event @x to the root's subscriptions, if any"""
+		r = self.root()
+		if r is None:
+			return # pragma: no cover
+		r = r.root # may be a subdir
+		if r is None or (r._subs is None and not r._streams):
+			return
+		path = self._path(x.key)
+		if path:
+			await r._notify(path, x)
+
+	def _path(self, key):
+		"""The path of etcd key @key, relative to the tree's root"""
+		if not key.startswith(self.extkey+'/'):
+			return None
+		path = tuple(k for k in key[len(self.extkey)+1:].split('/') if k != '')
+		r = self.root()
+		rr = r.root if r is not None else None
+		if rr is not None and r is not rr:
+			path = r.path.as_tuple()[len(rr.path):] + path
+		return path
+
+	def _remember(self, key, node):
+		nodes = self._nodes
+		nodes[key] = weakref.ref(node)
+		nodes.move_to_end(key)
+		if len(nodes) > self.cache_size:
+			nodes.popitem(last=False)
+
+	def _forget(self, key):
+		self._nodes.pop(key,None)
+
+	def _cached(self, key):
+		ref = self._nodes.get(key,None)
+		if ref is None:
+			return None
+		node = ref()
+		if node is None:
+			del self._nodes[key]
+		else:
+			self._nodes.move_to_end(key)
+		return node
 
-		except GeneratorExit:
-			logger.debug("READER GenEx: %s",id(self))
-			raise
-		except asyncio.CancelledError:
-			logger.debug("READER cancelled: %s", id(self))
-			raise
-		except BaseException as e:
-			if type(e) is not RuntimeError or "Event loop is closed" not in str(e):
-				logger.exception("READER died: %s", id(self))
+	async def _resync(self, res):
+		"""\
+			Update the tree to match @res, a recursive read of it,
+			after events have been lost.
+			"""
+		r = self.root()
+		if r is None: # pragma: no cover
+			return False
+		if r._streams:
+			# they can't be told what changed
+			exc = etcd.EtcdEventIndexCleared("Events lost, tree re-read at %d" % res.etcd_index)
+			for st in list(r._streams):
+				st.close(exc)
+		try:
+			for d in (r.root._overlay, self._floors):
+				for k,i in list(d.items()):
+					if i <= res.etcd_index:
+						del d[k]
+			await self._resync_dir(r, res, res.etcd_index)
+		except Exception as e:
+			logger.exception("Error in resyncing")
 			if not self.stopped.done():
 				self.stopped.set_exception(e)
-			raise
-		else:
-			logger.debug("READER ended: %s", id(self))
-			if not self.stopped.done():
-				self.stopped.set_result("end")
-		finally:
-			conn.close()
+			return False
+		return True
+
+	async def _resync_dir(self, node, pre, seq):
+		from .node import EtcAwaiter
 
-	async def _write(self,x):
+		names = set()
+		for c in pre.child_nodes:
+			names.add(c.name)
+			v = node._data.get(c.name, None)
+			if v is not None and type(v) is not EtcAwaiter and v._is_dir != c.dir:
+				await v._ext_delete(seq=seq)
+				v = None
+			if v is None:
+				await node._new(parent=node, key=c.name, pre=c, recursive=True)
+			elif type(v) is not EtcAwaiter: # those get current data when loaded
+				await v._ext_update(c)
+				if c.dir:
+					await self._resync_dir(v, c, seq)
+		for k,v in list(node._data.items()):
+			if k not in names:
+				await v._ext_delete(seq=seq)
+
+	async def _write(self,x, local=False):
 		"""\
-			Callback which processes incoming events
+			Process an incoming event.
+			Returns False if the watcher had to be stopped.
+
+			@local is set when applying the result of our own write,
+			see EtcRoot._apply_local(). Errors are raised instead of
+			stopping the watcher.
 			"""
 		from .node import EtcAwaiter
 
@@ -455,10 +802,49 @@ class EtcWatcher(object):
 			r = self.root()
 			if r is None: # pragma: no cover
 				logger.debug("Write ending")
-				return
+				return False
+
+			fl = self._floors
+			if fl and not local:
+				pre = None
+				if x.dir and x.action in {'compareAndDelete','delete','expire'}:
+					pre = x.key+'/'
+				for k,i in list(fl.items()):
+					if i < x.modifiedIndex:
+						del fl[k] # events arrive in order
+					elif x.key == k or x.key.startswith(k+'/'):
+						raise SkipAhead # that subtree is newer
+					elif pre is not None and k.startswith(pre):
+						# The subtree is deleted along with its parent;
+						# the events which re-created it must not be
+						# skipped.
+						del fl[k]
+
+			ov = r.root._overlay
+			if ov and not local:
+				# Our own write to this key has been applied already.
+				# Older events must not undo it; its own event is
+				# processed normally, which restores the node in case
+				# an older deletion of a parent removed it.
+				idx = ov.get(x.key,None)
+				if idx is not None:
+					if x.modifiedIndex < idx:
+						raise SkipAhead
+					del ov[x.key]
+				if x.dir and x.action in {'compareAndDelete','delete','expire'}:
+					pre = x.key+'/'
+					for k in [k for k,i in ov.items() if i <= x.modifiedIndex and k.startswith(pre)]:
+						del ov[k]
+
+			n = self._cached(x.key)
+			if n is not None:
+				if x.action in {'compareAndDelete','delete','expire'}:
+					await n._ext_delete(seq=x.modifiedIndex)
+				else:
+					await n._ext_update(x)
+				return True
 
-			key = x.key[len(self.extkey):]
-			key = tuple(k for k in key.split('/') if k != '')
+			key = [k for k in x.key[len(self.extkey):].split('/') if k != '']
 
 			if x.action in {'compareAndDelete','delete','expire'}:
 				for k in key:
@@ -486,12 +872,13 @@ class EtcWatcher(object):
 						r = r.get(key[-1], raw=True)
 					except KeyError:
 						logger.debug("Write new %s %s",r,key)
-						r = await r._new(parent=r,key=key,pre=x,recursive=False)
+						r = await r._new(parent=r,key=key[-1],pre=x,recursive=False)
 					logger.debug("Write done %s",r)
 					if type(r) is EtcAwaiter:
-						await r.load(pre=x,recursive=False)
+						r = await r.load(pre=x,recursive=False)
 					else:
 						await r._ext_update(x)
+					self._remember(x.key, r)
 				else:
 					logger.debug("Write upd %s",r)
 					await r._ext_update(x)
@@ -502,19 +889,25 @@ class EtcWatcher(object):
 			logger.debug("Write watcher cancelled")
 			raise
 		except Exception as e:
+			if local:
+				raise
 			logger.exception("Error in write watcher")
 			if not self.stopped.done():
 				self.stopped.set_exception(e)
-			return
+			return False
+		return True
 
-		async with self.uptodate:
-			self.last_seen = x.modifiedIndex
-			self.uptodate.notify_all()
-			logger.debug("DONE %d: %s",x.modifiedIndex,id(self))
+	async def _write_local(self, x):
+		"""Apply the result of our own write, see EtcRoot._apply_local()"""
+		async with self._lock:
+			if x.modifiedIndex <= self.last_applied:
+				return # the watcher got there first
+			await self._write(x, local=True)
 
 class EtcTypes(object):
 	doc = None
 	pri = 0
+	_matcher = None
 
 	def __init__(self):
 		self.type = [None,None]
@@ -538,6 +931,7 @@ class EtcTypes(object):
 		if self.type[dir] is not None:
 			raise RuntimeError("already registered")
 		self.type[dir] = cls
+		_types_changed()
 		return cls
 
 	def step(self,*key, dest=None):
@@ -556,12 +950,14 @@ class EtcTypes(object):
 			return self
 		if isinstance(key,str):
 			key = key.split('/')
+		top = self
 		for k in key[:-1]:
 			assert k != ''
 			res = self.nodes.get(k,None)
 			if res is None:
 				res = EtcTypes()
 				self.nodes[k] = res
+				top._changed(k)
 			self = res
 		k = key[-1]
 		assert k != ''
@@ -570,10 +966,20 @@ class EtcTypes(object):
 			if dest is None:
 				dest = EtcTypes()
 			self.nodes[k] = res = dest
+			top._changed(k)
 		else:
 			assert dest is None or dest is res
 		return res
 
+	def _changed(self, name=None):
+		_types_changed(name)
+
+	def _get_matcher(self):
+		m = self._matcher
+		if m is None or m.gen != _node._types_gen:
+			self._matcher = m = _TypesMatcher(self, _node._types_gen)
+		return m
+
 	def items(self,key=None):
 		"""\
 			Enumerate sub-entries matching this key.
@@ -647,6 +1053,7 @@ class EtcTypes(object):
 			done = True
 		if not done:
 			raise RuntimeError("What exactly are you trying to register?")
+		_types_changed()
 		return cls
 
 	def lookup(self, *path, dir, raw=False):
@@ -663,23 +1070,158 @@ class EtcTypes(object):
 			path = path[0]
 			if isinstance(path,str):
 				path = path.split('/')
-		nodes = [(".",self)]
+		m = self._get_matcher()
+		s = 0
+		last = len(path)-1
 		for i,p in enumerate(path):
-			d = dir if i == len(path)-1 else True
 			assert p != ''
-			cn = []
-			for k,n in nodes:
-				for nk,nn in n.items(p):
-					cn.append((nk,nn))
-					nn = getattr(nn.type[d],'_types',None)
-					if nn is not None:
-						cn.append((nk,nn))
-				if k == '**':
-					cn.append((k,n))
-			if not cn:
+			s = m.step(s, p, dir if i == last else True)
+			if s is None:
 				return None
-			nodes = cn
+		n = m.result(s, dir)
+		if n is None:
+			return None
+		t = n.type[dir]
+		if isinstance(t,str):
+			n.type[dir] = t = import_string(t)
+			_types_changed()
+		if dir is True:
+			assert issubclass(t,EtcDir)
+		elif dir is False:
+			assert issubclass(t,EtcXValue),t
+		return n if raw else t
+
+	def matches(self, path):
+		"""\
+			Return all entries whose pattern matches @path (a sequence of
+			names), regardless of type or priority.
 
+			This is called on the root node.
+			"""
+		m = self._get_matcher()
+		s = 0
+		for p in path:
+			s = m.step(s, p, True)
+			if s is None:
+				return ()
+		return m.entries(s)
+
+class _Patterns(EtcTypes):
+	"""\
+		The pattern tree of EtcRoot.subscribe(). It is matched like
+		EtcTypes, but as it doesn't assign any types, changing it leaves
+		type lookups (and their caches) alone.
+		"""
+	def __init__(self):
+		super().__init__()
+		self.gen = 0
+		self.names = {} # name => number of entries
+
+	def _changed(self, name=None):
+		self.gen += 1
+		if name is not None:
+			self.names[name] = self.names.get(name,0)+1
+
+	def _get_matcher(self):
+		m = self._matcher
+		if m is None or m.gen != self.gen:
+			self._matcher = m = _TypesMatcher(self, self.gen, self.names)
+		return m
+
+	def prune(self, path, keep):
+		"""\
+			Remove the entries along @path, starting from the end, which
+			have no sub-entries and are not in @keep.
+			"""
+		trail = []
+		n = self
+		for k in path:
+			trail.append((n,k))
+			n = n.nodes[k]
+		for n,k in reversed(trail):
+			c = n.nodes[k]
+			if c.nodes or c in keep:
+				break
+			del n.nodes[k]
+			self.gen += 1
+			cnt = self.names[k]-1
+			if cnt:
+				self.names[k] = cnt
+			else:
+				del self.names[k]
+
+class _TypesMatcher(object):
+	"""\
+		A lazily-built deterministic automaton for EtcTypes.lookup().
+
+		Each state is the list of (name,EtcTypes) candidates the original
+		NFA-style matching would have collected at that point. Path
+		elements are first reduced to the symbol that matches them (see
+		node._types_pattern), so transitions are cached per symbol.
+
+		Any change to any registration invalidates this; EtcTypes.lookup()
+		then creates a new one.
+		"""
+	def __init__(self, types, gen, names=None):
+		self.gen = gen
+		self.names = names
+		self.states = [(('.',types),)]
+		self.ids = {}
+		self.next = {}
+		self.done = {}
+		self.found = {}
+
+	def step(self, s, p, d):
+		"""Advance state @s by path element @p. @d is the dir flag."""
+		p, = _types_pattern((p,), self.names)
+		try:
+			return self.next[(s,p,d)]
+		except KeyError:
+			pass
+		cn = []
+		seen = set()
+		def add(k,n):
+			if (k,id(n)) not in seen:
+				seen.add((k,id(n)))
+				cn.append((k,n))
+		for k,n in self.states[s]:
+			for nk,nn in n.items(p):
+				add(nk,nn)
+				nn = getattr(nn.type[d],'_types',None)
+				if nn is not None:
+					add(nk,nn)
+			if k == '**':
+				add(k,n)
+		if cn:
+			cn = tuple(cn)
+			ns = self.ids.get(cn,None)
+			if ns is None:
+				ns = self.ids[cn] = len(self.states)
+				self.states.append(cn)
+		else:
+			ns = None
+		self.next[(s,p,d)] = ns
+		return ns
+
+	def entries(self, s):
+		"""All distinct EtcTypes entries of state @s"""
+		try:
+			return self.found[s]
+		except KeyError:
+			pass
+		res = []
+		for k,n in self.states[s]:
+			if k != '.' and n not in res:
+				res.append(n)
+		res = self.found[s] = tuple(res)
+		return res
+
+	def result(self, s, dir):
+		"""The highest-priority EtcTypes entry of state @s that has a @dir type"""
+		try:
+			return self.done[(s,dir)]
+		except KeyError:
+			pass
 		def by_pri(k):
 			k=k[1].type
 			if k[0] is None or not hasattr(k[0],'pri'):
@@ -688,15 +1230,10 @@ class EtcTypes(object):
 				return -k[0].pri
 			else:
 				return -max(k[0].pri, k[1].pri)
-		for p,n in sorted(nodes, key=by_pri):
-			t = n.type[dir]
-			if t is not None:
-				if isinstance(t,str):
-					n.type[dir] = t = import_string(t)
-				if dir is True:
-					assert issubclass(t,EtcDir)
-				elif dir is False:
-					assert issubclass(t,EtcXValue),t
-				return n if raw else t
-		return None
-
+		res = None
+		for p,n in sorted(self.states[s], key=by_pri):
+			if n.type[dir] is not None:
+				res = n
+				break
+		self.done[(s,dir)] = res
+		return res
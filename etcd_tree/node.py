@@ -37,20 +37,25 @@ This declares nodes for the basic etcTree structure.
 
 import weakref
 import time
+import heapq
+import json
+import os
 import asyncio
 from itertools import chain
-from collections.abc import MutableMapping
+from collections import deque, OrderedDict
+from collections.abc import MutableMapping, Sequence
 from contextlib import suppress
 import aio_etcd as etcd
-from etcd import EtcdResult, EtcdKeyNotFound
-from functools import wraps
+from etcd import EtcdResult, EtcdKeyNotFound, EtcdEventIndexCleared
+from functools import wraps, partial
 from .util import hybridmethod
 from traceback import print_exc
 import attr
 
 __all__ = ('EtcBase','EtcAwaiter','EtcDir','EtcRoot','EtcValue','EtcXValue',
 	'EtcString','EtcFloat','EtcInteger','EtcBoolean',
-	'ReloadData','ReloadRecursive',
+	'ReloadData','ReloadRecursive', 'EtcPath', 'Change','ChangeSet',
+	'Subscription', 'ChangeEvent','ChangeStream',
 	)
 
 class _NOTGIVEN:
@@ -58,10 +63,318 @@ class _NOTGIVEN:
 _later_idx = 1
 _later_tag = 1
 
+# Type lookup cache support. EtcTypes calls _types_changed() whenever a
+# registration is modified; that invalidates every cached lookup.
+_types_gen = 1
+_types_names = set()
+
+def _types_changed(name=None):
+	global _types_gen
+	_types_gen += 1
+	if name is not None:
+		_types_names.add(name)
+
+def _types_pattern(path, names=None):
+	"""\
+		Replace path elements which no EtcTypes knows about with the
+		wildcard they'd be matched by. Lookups of the resulting pattern
+		return the same result as lookups of the original path.
+
+		@names defaults to the names of all registrations.
+		"""
+	if '' in path:
+		raise ValueError("Empty path element", path)
+	if names is None:
+		names = _types_names
+	return tuple(p if p in names else ':*' if p[0] == ':' else '*' for p in path)
+
+def _types_path(path):
+	"""Normalize a type lookup path, the same way EtcTypes.lookup() does"""
+	if len(path) == 1:
+		path = path[0]
+		if isinstance(path,str):
+			path = path.split('/')
+	path = tuple(path)
+	if '' in path:
+		raise ValueError("Empty path element", path)
+	return path
+
+async def _read(conn, key, limit, **kw):
+	"""Read from etcd; @limit is an optional semaphore"""
+	if limit is None:
+		return (await conn.read(key, **kw))
+	async with limit:
+		return (await conn.read(key, **kw))
+
+async def _gather(jobs, loop):
+	"""Run a list of coroutines concurrently; cancel the rest if one fails"""
+	jobs = [asyncio.ensure_future(j, loop=loop) for j in jobs]
+	try:
+		return (await asyncio.gather(*jobs, loop=loop))
+	except BaseException:
+		for j in jobs:
+			j.cancel()
+		raise
+
+async def _pipeline(ops, window, loop):
+	"""\
+		Call the coroutine functions in @ops, in order, with at most
+		@window of them running. Returns the highest result (a
+		modifiedIndex) or None.
+		"""
+	if not ops:
+		return None
+	sem = asyncio.Semaphore(window, loop=loop)
+	async def run(op):
+		async with sem:
+			return (await op())
+	res = await _gather((run(op) for op in ops), loop=loop)
+	return max((r for r in res if r is not None), default=None)
+
+_READY = object() # EtcBase._ready: set, nobody waits
+_DELETE = object() # EtcRoot._write_later: delete the key
+
+class _Timer:
+	"""\
+		A deadline in EtcRoot's timer heap, see EtcRoot._call_later().
+		Can be cancelled like an asyncio.TimerHandle.
+		"""
+	__slots__ = ('key','when','callback','args','owner')
+
+	def __init__(self, owner, when, callback, args):
+		self.owner = owner
+		self.key = self.when = when
+		self.callback = callback
+		self.args = args
+
+	def __lt__(self, other):
+		return self.key < other.key
+
+	def reset(self, delay, *args):
+		"""\
+			Postpone the deadline. The heap position isn't touched;
+			the timer is re-queued when it comes up.
+			"""
+		self.when = self.owner._loop.time()+delay
+		self.args = args
+
+	def cancel(self):
+		if self.callback is not None:
+			self.callback = None
+			self.owner._timers_dead += 1
+
+async def _ready_now():
+	return True
+
+class _NameLock:
+	"""\
+		Serializes creating the child @name of @node.
+		Locks are kept in a plain dict, node._locks, and dropped as soon
+		as nobody holds or waits for them.
+		"""
+	def __init__(self, node, name):
+		self.node = node
+		self.name = name
+		try:
+			locks = node._locks
+		except AttributeError:
+			locks = node._locks = {}
+		e = locks.get(name, None)
+		if e is None:
+			e = locks[name] = [asyncio.Lock(loop=node._loop), 0]
+		e[1] += 1
+		self.entry = e
+
+	async def __aenter__(self):
+		try:
+			await self.entry[0].acquire()
+		except BaseException:
+			self._drop()
+			raise
+
+	async def __aexit__(self, *tb):
+		self.entry[0].release()
+		self._drop()
+
+	def _drop(self):
+		e = self.entry
+		e[1] -= 1
+		if not e[1]:
+			locks = self.node._locks
+			del locks[self.name]
+			if not locks:
+				del self.node._locks
+
+class EtcPath(Sequence):
+	"""\
+		The path of a node, relative to the connection's root.
+
+		A path only stores its last element and a link to its parent's
+		path, so creating a node doesn't copy the parent's path. It
+		behaves like, and compares equal to, the tuple of its elements;
+		that tuple is only built when needed.
+		"""
+	__slots__ = ('_parent','_name','_len','_hash')
+
+	def __init__(self, parent=None, name=None):
+		self._parent = parent
+		self._name = name
+		self._len = 0 if parent is None else parent._len+1
+		self._hash = None
+
+	@classmethod
+	def of(cls, names):
+		"""Convert an iterable of names to a path"""
+		if isinstance(names,EtcPath):
+			return names
+		p = _EMPTY_PATH
+		for n in names:
+			p = EtcPath(p,n)
+		return p
+
+	def as_tuple(self):
+		res = [None]*self._len
+		p = self
+		for i in range(self._len-1,-1,-1):
+			res[i] = p._name
+			p = p._parent
+		return tuple(res)
+
+	def __len__(self):
+		return self._len
+
+	def __iter__(self):
+		return iter(self.as_tuple())
+
+	def __getitem__(self, i):
+		if isinstance(i,slice):
+			return self.as_tuple()[i]
+		if i < 0:
+			i += self._len
+		if not 0 <= i < self._len:
+			raise IndexError(i)
+		p = self
+		for _ in range(self._len-1-i):
+			p = p._parent
+		return p._name
+
+	def __add__(self, other):
+		p = self
+		for n in other:
+			p = EtcPath(p,n)
+		return p
+
+	def __radd__(self, other):
+		return tuple(other)+self.as_tuple()
+
+	def __hash__(self):
+		h = self._hash
+		if h is None:
+			h = self._hash = hash(self.as_tuple())
+		return h
+
+	def __eq__(self, other):
+		if self is other:
+			return True
+		if isinstance(other,EtcPath):
+			if self._len != other._len:
+				return False
+			if self._hash is not None and other._hash is not None and self._hash != other._hash:
+				return False
+			a,b = self,other
+			while a is not b:
+				if a._name != b._name:
+					return False
+				a,b = a._parent,b._parent
+			return True
+		if isinstance(other,tuple):
+			return self._len == len(other) and self.as_tuple() == other
+		return NotImplemented
+
+	def __ne__(self, other):
+		res = self.__eq__(other)
+		return res if res is NotImplemented else not res
+
+	def __reduce__(self):
+		return EtcPath.of,(self.as_tuple(),)
+
+	def __repr__(self):
+		return repr(self.as_tuple())
+
+_EMPTY_PATH = EtcPath()
+
 @attr.s
 class NotConverted:
 	value = attr.ib()
 
+@attr.s
+class Change:
+	"""\
+		One child of a directory, as reported to change monitors.
+
+		@old: the value before the update interval (None if added)
+		@new: the current value (None if deleted)
+		@seq: the child's modifiedIndex
+
+		Subdirectories are reported as the node itself.
+		"""
+	old = attr.ib()
+	new = attr.ib()
+	seq = attr.ib()
+
+@attr.s
+class ChangeSet:
+	"""\
+		What happened to a directory's children since its monitors were
+		last called. Each attribute maps child names to Change objects.
+		"""
+	added = attr.ib(default=attr.Factory(dict))
+	deleted = attr.ib(default=attr.Factory(dict))
+	changed = attr.ib(default=attr.Factory(dict))
+
+	def __bool__(self):
+		return bool(self.added or self.deleted or self.changed)
+
+@attr.s
+class ChangeEvent:
+	"""\
+		One change, as yielded by EtcRoot.changes().
+
+		@path: a tuple of names, relative to the root
+		@action: the etcd action (set, update, delete, expire …)
+		@old: the previous value, if etcd sent it
+		@new: the new value; None for deletions and directories
+		@seq: the modifiedIndex
+
+		Values are the strings etcd stores.
+		"""
+	path = attr.ib()
+	action = attr.ib()
+	old = attr.ib()
+	new = attr.ib()
+	seq = attr.ib()
+
+	@classmethod
+	def _from(cls, path, x):
+		prev = getattr(x,'_prev_node',None)
+		return cls(path, x.action, None if prev is None else prev.value, x.value, x.modifiedIndex)
+
+class _ChangeCallback:
+	# marks a monitor that wants a ChangeSet, see EtcDir.add_monitor()
+	__slots__ = ('callback',)
+	def __init__(self, callback):
+		self.callback = callback
+	def __call__(self, node):
+		return self.callback(node, node.changes)
+
+class _Raw:
+	"""A value that has not been decoded yet, see EtcXValue.lazy"""
+	__slots__ = ('value',)
+	def __init__(self, value):
+		self.value = value
+	def __repr__(self):
+		return "<raw %s>" % (repr(self.value),)
+
 def EtcNull(*a,**k):
 	raise RuntimeError("You can't assemble an etcd-tree node from scratch")
 
@@ -141,6 +454,171 @@ class MonitorCallback(object):
 	def __call__(self,x):
 		return self.callback(x)
 
+class Subscription(object):
+	"""A cancellable token for EtcRoot.subscribe()"""
+	def __init__(self, root,pattern,entry,callback):
+		self.root = weakref.ref(root)
+		self.pattern = pattern
+		self.entry = entry
+		self.callback = callback
+	def cancel(self):
+		root = self.root()
+		if root is None:
+			return # pragma: no cover
+		root._unsubscribe(self)
+	def __call__(self,path,event):
+		return self.callback(path,event)
+
+# Bounded async iterator for EtcRoot.changes()
+
+class ChangeStream(object):
+	"""\
+		An async iterator of ChangeEvent objects, see EtcRoot.changes().
+
+		@dropped counts the events which got discarded because the
+		buffer was full.
+		"""
+	backfill_timeout = 1
+	error = None
+
+	def __init__(self, root, prefix=(), since=None, maxlen=1000, overflow='drop'):
+		if overflow not in ('block','drop','collapse'):
+			raise ValueError(overflow)
+		self.root = weakref.ref(root)
+		self._loop = root._loop
+		self.prefix = tuple(prefix)
+		self.since = since
+		self.maxlen = maxlen
+		self.overflow = overflow
+		self.dropped = 0
+		self.closed = False
+		self._buf = OrderedDict() if overflow == 'collapse' else deque()
+		self._getter = None
+		self._putter = None
+		self._start = None
+		w = root._watcher
+		if since is not None and w is not None and since < w.last_applied:
+			# events up to this are already in the tree
+			self._start = w.last_applied
+
+	def __aiter__(self):
+		return self
+
+	async def __anext__(self):
+		if self._start is not None:
+			await self._backfill()
+		buf = self._buf
+		while not buf:
+			if self.closed:
+				if self.error is not None:
+					raise self.error
+				raise StopAsyncIteration
+			self._getter = f = asyncio.Future(loop=self._loop)
+			try:
+				await f
+			finally:
+				self._getter = None
+		if self.overflow == 'collapse':
+			ev = buf.popitem(last=False)[1]
+		else:
+			ev = buf.popleft()
+		f = self._putter
+		if f is not None and not f.done():
+			f.set_result(None)
+		return ev
+
+	def close(self, error=None):
+		"""\
+			Stop the stream. Buffered events can still be read;
+			then @error is raised, if given.
+			"""
+		if self.closed:
+			return
+		self.closed = True
+		self.error = error
+		for f in (self._getter,self._putter):
+			if f is not None and not f.done():
+				f.set_result(None)
+		root = self.root()
+		if root is not None and root._streams is not None:
+			root._streams.discard(self)
+
+	def _wanted(self, path):
+		p = self.prefix
+		return path[:len(p)] == p
+
+	async def _add(self, ev):
+		if self.closed:
+			return
+		if self.since is not None and ev.seq <= self.since:
+			return
+		buf = self._buf
+		if self.overflow == 'collapse':
+			prev = buf.pop(ev.path,None)
+			if prev is not None:
+				ev = ChangeEvent(ev.path, ev.action, prev.old, ev.new, ev.seq)
+			elif len(buf) >= self.maxlen:
+				self.dropped += 1
+				return
+			buf[ev.path] = ev
+		else:
+			while len(buf) >= self.maxlen:
+				if self.overflow == 'drop':
+					buf.popleft()
+					self.dropped += 1
+					continue
+				# block the watcher until the consumer catches up
+				self._putter = f = asyncio.Future(loop=self._loop)
+				try:
+					await f
+				finally:
+					self._putter = None
+				if self.closed:
+					return
+			buf.append(ev)
+		f = self._getter
+		if f is not None and not f.done():
+			f.set_result(None)
+
+	async def _backfill(self):
+		# Replay etcd's event history between @since and the point
+		# where this stream was attached to the watcher.
+		start,self._start = self._start,None
+		root = self.root()
+		if root is None or root._watcher is None:
+			return
+		w = root._watcher
+		idx = self.since+1
+		evs = []
+		while idx <= start:
+			try:
+				x = await asyncio.wait_for(root._conn.client.read(w.extkey, wait=True,
+					waitIndex=idx, recursive=True), self.backfill_timeout, loop=self._loop)
+			except (asyncio.TimeoutError,EtcdEventIndexCleared) as exc:
+				# there's a gap, so the rest is useless
+				self._buf.clear()
+				self.close(exc)
+				raise
+			if x.modifiedIndex > start:
+				break
+			idx = x.modifiedIndex+1
+			path = w._path(x.key)
+			if path and self._wanted(path):
+				evs.append(ChangeEvent._from(path, x))
+		if evs:
+			# these come before anything the watcher sent
+			buf = self._buf
+			if self.overflow == 'collapse':
+				old,self._buf = buf,OrderedDict()
+				for ev in evs:
+					self._buf.pop(ev.path,None)
+					self._buf[ev.path] = ev
+				for k,ev in old.items():
+					self._buf.pop(k,None)
+					self._buf[k] = ev
+			else:
+				buf.extendleft(reversed(evs))
+
 # Helper for possibly-asynchronously iterating through a tree
 
 class _tagged_iter:
@@ -213,18 +691,25 @@ class EtcBase(object):
 
 		All mthods have a leading underscore, which is necessary because
 		non-underscored names are potential etcd node names.
+
+		Attributes every node has live in slots. Everything else, including
+		attributes added by subclasses, goes to the instance dict, which
+		most nodes thus never need to allocate.
 		"""
+	__slots__ = ('__dict__','__weakref__', '_parent','_root','_loop', 'name','path',
+		'_seq','_cseq','_ttl','_timestamp', '_later_mon','_ready','_ready_not',
+		'_propagate','is_new')
+
 	_later_timer = None
 	_later_timer_max = None
 	_later_max = False
 	_later_warned = False
 	_env = _NOTGIVEN
 	_propagate_updates = None
-	is_new = True # for monitors: False after the first call to has_update()
 	busy = None
 
 	@classmethod
-	async def _new(cls, parent=None, conn=None, key=None, pre=None,recursive=None, typ=None, **kw):
+	async def _new(cls, parent=None, conn=None, key=None, pre=None,recursive=None, typ=None, limit=None, **kw):
 		"""\
 			This classmethod loads data (if necessary) and creates a class from a base.
 
@@ -234,6 +719,9 @@ class EtcBase(object):
 
 			If @recursive is True, @pre needs to have been recursively
 			fetched from etcd.
+
+			If @limit is a semaphore, sibling subdirectories are loaded
+			concurrently; @limit bounds the number of reads in flight.
 			"""
 		kw['_no_update_parent'] = True
 		#logger.debug("_new %d %s %s",id(parent),parent,key)
@@ -244,7 +732,7 @@ class EtcBase(object):
 			assert key is not None
 		if key is None:
 			key = (parent.path if parent else ())+(pre.name,)
-		elif isinstance(key,tuple):
+		elif isinstance(key,(tuple,EtcPath)):
 			if key:
 				name = key[-1]
 			else:
@@ -253,13 +741,7 @@ class EtcBase(object):
 			name = key.rsplit('/',1)[-1]
 
 		p = (parent if parent is not None else conn)
-		if not hasattr (p,'_locks'):
-			p._locks = weakref.WeakValueDictionary()
-		lock = p._locks.get(name, None)
-		if lock is None:
-			lock = asyncio.Lock(loop=p._loop)
-			p._locks[name] = lock
-		async with lock:
+		async with _NameLock(p,name):
 			if parent is not None:
 				r = parent._data.get(name, None)
 				if r is not None and type(r) is not EtcAwaiter:
@@ -295,22 +777,22 @@ class EtcBase(object):
 						self = await get_cls()
 					except ReloadData:
 						assert pre is None
-						kw['pre'] = pre = await conn.read(key)
+						kw['pre'] = pre = await _read(conn,key, limit)
 						recursive = False
 						self = await get_cls()
 						# This way, if determining the class requires
 						# recursive content, we do not read twice
 					if pre is None:
-						kw['pre'] = pre = await conn.read(key)
+						kw['pre'] = pre = await _read(conn,key, limit)
 					if pre.dir:
-						await self._fill_data(pre=pre,recursive=irec)
+						await self._fill_data(pre=pre,recursive=irec, limit=limit)
 				except ReloadRecursive:
-					kw['pre'] = pre = await conn.read(key, recursive=True)
+					kw['pre'] = pre = await _read(conn,key, limit, recursive=True)
 					recursive = True
 					if self is None:
 						self = await get_cls()
 					if pre.dir:
-						await self._fill_data(pre=pre,recursive=True)
+						await self._fill_data(pre=pre,recursive=True, limit=limit)
 			except EtcdKeyNotFound:
 				raise KeyError(key) from None
 
@@ -333,24 +815,29 @@ class EtcBase(object):
 					raise ReloadData
 				name = pre.name
 			self.name = name
-			if self._propagate_updates is None:
-				self._propagate_updates = (self.name[0] != ':')
-			self.path = parent.path+(name,)
+			pu = self._propagate_updates
+			self._propagate = (self.name[0] != ':') if pu is None else pu
+			# a node replacing its EtcAwaiter re-uses its path
+			self.path = _fill.path if _fill is not None else EtcPath(parent.path,name)
 			if not _no_update_parent:
 				self._update_parent()
-			self._lock = asyncio.Lock(loop=self._loop)
 		else:
 			# This is a root node
 			self._root = weakref.ref(self)
+			self._propagate = bool(self._propagate_updates)
 
 		if pre is not None:
 			self._seq = pre.modifiedIndex
 			self._cseq = pre.createdIndex
 			self._ttl = pre.ttl
+		else:
+			self._seq = self._cseq = self._ttl = None
+		self.is_new = True # for monitors: False after the first call to has_update()
 		self._timestamp = time.time()
-		self._later_mon = weakref.WeakValueDictionary()
-		self._ready = asyncio.Event(loop=self._loop)
+		self._later_mon = None
+		self._ready = None
 		self._ready_not = True
+		self._mark_dirty()
 
 		if _fill is not None:
 			rs = weakref.ref(self)
@@ -358,8 +845,11 @@ class EtcBase(object):
 				if k not in self._data and type(v) is EtcAwaiter:
 					self._data[k] = v
 					v._parent = rs
+					if v._ready is not _READY:
+						v._mark_dirty()
 			_fill._done = self
-			self._later_mon.update(_fill._later_mon)
+			if _fill._later_mon:
+				self._later_mon = weakref.WeakValueDictionary(_fill._later_mon)
 
 		#logger.debug("init %d %s",id(self),self)
 
@@ -380,8 +870,7 @@ class EtcBase(object):
 			parent._added.add(name)
 		parent._data[name] = self
 
-		if not self._propagate_updates:
-			assert self._propagate_updates is False # "None" would be an error
+		if not self._propagate:
 			parent.updated(seq=self._seq)
 		# else: the update happens after my update handler is done
 
@@ -389,52 +878,74 @@ class EtcBase(object):
 		"""Delete this node, replacing it with an EtcAwaiter.
 			You need to make sure not to retain *any* references to the
 			node."""
+		self._forget()
 		p = self.parent
 		if p is not None:
 			del p._data[self.name]
 		self._parent = None
 		return EtcAwaiter(p, name=self.name)
+
+	def _forget(self):
+		"""Drop this node from the watcher's lookup cache"""
+		r = self.root
+		if r is None:
+			return
+		w = r._watcher
+		if w is not None and w._nodes:
+			w._forget(r._conn._extkey(self.path))
 		
 	@classmethod
 	async def this_obj(cls,recursive, **kw):
 		"""A method to intercept class creation."""
 		return cls(**kw)
 
-	async def _fill_data(self,pre,recursive):
-		"""Copy result data to the object. This may require re-reading recursively."""
-		# Collect all names to be added, process highest-priority items first
+	async def _fill_data(self,pre,recursive, limit=None):
+		"""\
+			Copy result data to the object. This may require re-reading recursively.
+
+			If @limit is a semaphore, subdirectories which need to be
+			read are loaded concurrently, one priority group at a time.
+			"""
+		# Classify all names to be added, process highest-priority items first
 		todo = {}
 		for c in pre.child_nodes:
 			todo[c.name]=c
+		full = set() # names whose entry in todo has been read recursively
+		types = None
 		while todo:
-			pri = None
+			if types is None or gen != _types_gen:
+				# (re)classify if a newly-loaded node registered some types
+				gen = _types_gen
+				types = await self._classify(todo, recursive, limit, full)
+				if not todo:
+					break
+			pri = max(t.pri for t,c in types.values())
 			current = {}
-			for n,c in todo.items():
-				try:
-					t = self.subtype(n,dir=c.dir,pre=(c if recursive or not c.dir else None),recursive=recursive, raw=True)
-				except ReloadData:
-					c = await self.root._conn.read(self.path+(n,))
-					t = self.subtype(n,dir=c.dir,pre=c, recursive=False, raw=True)
-				if pri is None or t.pri > pri:
-					pri = t.pri
-					current = {}
-				elif t.pri < pri:
-					continue
-				current[n] = (t,c)
+			for n,tc in types.items():
+				if tc[0].pri == pri:
+					current[n] = tc
 			for n,tc in current.items():
 				t,c = tc
 				if n not in self._data:
 					EtcAwaiter(parent=self,pre=c,name=n)
 				self._added.add(n)
+			jobs = []
 			for n,tc in current.items():
 				t,c = tc
 				del todo[n]
+				del types[n]
 				if c.dir and recursive is None:
 					pass
 				else:
 					a = self._data[n]
 					if isinstance(a,EtcAwaiter):
-						await a.load(pre=(c if recursive or not c.dir else None), recursive=recursive)
+						if limit is not None and c.dir and not recursive:
+							# needs to be read, so do that in parallel
+							jobs.append(a.load(recursive=recursive, limit=limit))
+						else:
+							await a.load(pre=(c if recursive or not c.dir else None), recursive=recursive)
+			if jobs:
+				await _gather(jobs, loop=self._loop)
 			if todo:
 				await self._run_update_step()
 
@@ -443,6 +954,45 @@ class EtcBase(object):
 				if isinstance(v,EtcAwaiter):
 					del self._data[k]
 		
+	async def _classify(self, todo, recursive, limit=None, full=None):
+		"""\
+			Classify the children in @todo, a name>EtcdResult dict.
+			Children which need their data for that are re-read with a
+			single recursive read of this directory; @todo is updated
+			with the new data (or loses entries which vanished meanwhile).
+
+			@full is an optional set of the names whose @todo entries
+			have been re-read like that, so that classifying them again
+			doesn't need another read. It is updated accordingly.
+			"""
+		if full:
+			types,reload = self.subtypes((c for n,c in todo.items() if n not in full), recursive=recursive)
+			more,rl = self.subtypes((todo[n] for n in full if n in todo), recursive=True)
+			if rl:
+				raise ReloadData(self.path+(rl[0],))
+			types.update(more)
+		else:
+			types,reload = self.subtypes(todo.values(), recursive=recursive)
+		if not reload:
+			return types
+		pre = await _read(self.root._conn,self.path, limit, recursive=True)
+		reload = set(reload)
+		more = []
+		for c in pre.child_nodes:
+			if c.name in reload:
+				reload.remove(c.name)
+				todo[c.name] = c
+				more.append(c)
+				if full is not None:
+					full.add(c.name)
+		for n in reload:
+			del todo[n]
+		more,reload = self.subtypes(more, recursive=True)
+		if reload:
+			raise ReloadData(self.path+(reload[0],))
+		types.update(more)
+		return types
+
 	async def init(self):
 		"""Last step after loading.
 			Do things like querying the remote system here."""
@@ -457,9 +1007,9 @@ class EtcBase(object):
 		return self
 
 	def _ext_load(self, **k):
-		return self.root.task(self.load,**k)
+		return self.root.task(self.load, _lane='load', **k)
 
-	async def load(self, recursive=None, pre=None):
+	async def load(self, recursive=None, pre=None, limit=None):
 		"Loader stub for code that's too lazy for testing. Do nothing."
 		return self
 
@@ -487,7 +1037,7 @@ class EtcBase(object):
 
 	@property
 	def _ready_p(self):
-		return 'R' if self._ready.is_set() else 'r' if self._ready_not else 'nr'
+		return 'R' if self._ready is _READY else 'r' if self._ready_not else 'nr'
 
 	@property
 	def _path(self):
@@ -504,6 +1054,10 @@ class EtcBase(object):
 			res = super().__repr__()
 			return res[:-1]+" ?? "+res[-1]
 
+	def _raw_value(self):
+		"""The value, as stored in etcd"""
+		return self._dump(self._value)
+
 	def _get_ttl(self):
 		if self._ttl is None:
 			return None
@@ -512,7 +1066,7 @@ class EtcBase(object):
 		kw = {}
 		if not self._is_dir:
 			kw['index'] = self._seq
-		self.root.task(self.root._set,self.path,self._dump(self._value), ttl=ttl, dir=self._is_dir, create=False, _die=True, **kw)
+		self.root.task(self.root._set,self.path,self._raw_value(), ttl=ttl, dir=self._is_dir, create=False, _die=True, _lane='write', **kw)
 	def _del_ttl(self):
 		self._set_ttl('')
 	ttl = property(_get_ttl, _set_ttl, _del_ttl)
@@ -523,7 +1077,7 @@ class EtcBase(object):
 		kw = {}
 		if not self._is_dir:
 			kw['index'] = self._seq
-		r = await root._set(self.path,self._dump(self._value), ttl=ttl, dir=self._is_dir, create=False, **kw)
+		r = await root._set(self.path,self._raw_value(), ttl=ttl, dir=self._is_dir, create=False, **kw)
 		r = r.modifiedIndex
 		if sync:
 			await root.wait(r)
@@ -549,17 +1103,59 @@ class EtcBase(object):
 		if root is None:
 			return
 		updlogger.debug("%d:Force %s",root._debug_id, self)
-		return self.task(self._run_update_base)
+		return self.task(self._run_update_base, _lane='update')
 
 	@property
 	def ready(self):
 		"""An awaitable that triggers when no update calls are pending"""
-		return self._ready.wait()
+		r = self._ready
+		if r is _READY:
+			return _ready_now()
+		if r is None:
+			r = self._ready = asyncio.Event(loop=self._loop)
+		return r.wait()
 
 	@property
 	def is_ready(self):
 		"""A flag indicating that no update calls are pending"""
-		return self._ready.is_set()
+		return self._ready is _READY
+
+	@property
+	def _lock(self):
+		# rarely used, thus allocated on demand
+		try:
+			return self.__dict__['_lock']
+		except KeyError:
+			l = self.__dict__['_lock'] = asyncio.Lock(loop=self._loop)
+			return l
+
+	def _set_ready(self):
+		r = self._ready
+		if r is not _READY:
+			if r is not None:
+				r.set()
+			self._ready = _READY
+
+	def _clear_ready(self):
+		# An Event that's not set may have waiters, so keep it
+		if self._ready is _READY:
+			self._ready = None
+			self._mark_dirty()
+
+	def _mark_dirty(self):
+		# Tell the parent's update pass to visit me. The parent's _dirty
+		# (a dict, for stable ordering) may contain stale names;
+		# _run_update_step() skips those.
+		p = self._parent
+		if p is None:
+			return
+		p = p()
+		if p is None:
+			return
+		d = p._dirty
+		if d is None:
+			p._dirty = d = {}
+		d[self.name] = None
 
 	def updated(self, seq=None):
 		"""\
@@ -569,14 +1165,14 @@ class EtcBase(object):
 		r = self.root
 		if r is None:
 			return
-		updlogger.debug("%d:updated %s seq %s rdy %s prop %s",r._debug_id,self,seq,self._ready_p,self._propagate_updates)
+		updlogger.debug("%d:updated %s seq %s rdy %s prop %s",r._debug_id,self,seq,self._ready_p,self._propagate)
 
 		p = self
-		while p._propagate_updates and p is not r:
-			if not p._ready_not and not p._ready.is_set():
+		while p._propagate and p is not r:
+			if not p._ready_not and p._ready is not _READY:
 				updlogger.debug("%d:waiting %s",r._debug_id,p)
 				return
-			p._ready.clear()
+			p._clear_ready()
 			p._ready_not = False
 			p = p.parent
 		p._queue_update()
@@ -585,14 +1181,16 @@ class EtcBase(object):
 	#
 	# - Initial state: _tag is zero, _timer and _maxtimer are None.
 	# - Starting timer: _tag >0, _timer started, _maxtimer started.
-	# - Restarting timer: _tag left alone, _timer cancelled and restarted.
+	# - Restarting timer: _tag left alone, _timer postponed.
 	# - Timer triggers: queues update, clears _timer and _tag.
 	# - Restarting timer: _tag updated, _timer started.
 	# - Queued update: notes that the tag has changed, doesn't run.
+	#
+	# Timers live in the root's heap (EtcRoot._call_later), not the loop's.
 
 	def _queue_update(self):
 		updlogger.debug("%d:queue %s",self.root._debug_id if self.root else 0, self)
-		self._ready.clear()
+		self._clear_ready()
 		if self._later_max:
 			return
 		if self._later_timer is None or self._later_tag > 0:
@@ -608,12 +1206,16 @@ class EtcBase(object):
 		except AttributeError:
 			# this happens when the root has gone away. Exit.
 			return
+		root = self.root
+		if root is None:
+			return
 		if self._later_timer is not None:
-			self._later_timer.cancel()
-		self._later_timer = self._loop.call_later(delay, self._run_update_reg, self._later_tag)
+			self._later_timer.reset(delay, self._later_tag)
+		else:
+			self._later_timer = root._call_later(delay, self._run_update_reg, self._later_tag)
 
 		if self._later_timer_max is None:
-			self._later_timer_max = self._loop.call_later(max_delay, self._run_update_max)
+			self._later_timer_max = root._call_later(max_delay, self._run_update_max)
 	
 	def _run_update_reg(self, tag):
 		self._later_timer = None
@@ -622,7 +1224,7 @@ class EtcBase(object):
 		if root is None or root.closed:
 			return
 		updlogger.debug("%d:start %s",root._debug_id,self)
-		root.task(self._run_update, tag, _die=True)
+		root.task(self._run_update, tag, _die=True, _lane='update')
 
 	def _run_update_max(self):
 		self._later_timer_max = None
@@ -638,7 +1240,7 @@ class EtcBase(object):
 		self._later_warned = True
 		self._later_tag = 0
 		self._later_max = True
-		root.task(self._run_update,0, _die=True)
+		root.task(self._run_update,0, _die=True, _lane='update')
 
 	async def _run_update(self, tag):
 		updlogger.debug("%d:upd %s %s %d/%d",self.root._debug_id, self, self._later_max, tag,self._later_tag)
@@ -655,7 +1257,7 @@ class EtcBase(object):
 
 	async def _run_update_base(self):
 		# clear subsequently-queued timers
-		if not self._propagate_updates:
+		if not self._propagate:
 			self._later_tag = 0
 			self._later_max = False
 			if self._later_timer is not None:
@@ -667,19 +1269,23 @@ class EtcBase(object):
 		await self._run_update_step()
 	
 	async def _run_update_step(self):
-		updlogger.debug("%d:Step %s %s",self.root._debug_id, self, not self._ready.is_set())
-		if self._ready.is_set():
+		updlogger.debug("%d:Step %s %s",self.root._debug_id, self, self._ready is not _READY)
+		if self._ready is _READY:
 			return
-		vd = getattr(self,'_data',None)
-		if vd:
-			again = True
-			while again:
-				again = False
-				for v in list(vd.values()):
-					if not v._ready.is_set():
-						again = True
-						await v._run_update_step()
-		self._ready.set()
+		# Children first. Only those that are not ready are in _dirty;
+		# a child may get dirty again while we wait for another.
+		d = getattr(self,'_dirty',None)
+		while d:
+			self._dirty = None
+			vd = self._data
+			if vd is None:
+				break
+			for name in d:
+				v = vd.get(name)
+				if v is not None and v._ready is not _READY:
+					await v._run_update_step()
+			d = self._dirty
+		self._set_ready()
 		try:
 			await self._call_monitors()
 		except Exception as exc:
@@ -720,6 +1326,8 @@ class EtcBase(object):
 			"""
 		global _later_idx
 		i,_later_idx = _later_idx,_later_idx+1
+		if self._later_mon is None:
+			self._later_mon = weakref.WeakValueDictionary()
 		self._later_mon[i] = mon = MonitorCallback(self,i,callback)
 		updlogger.debug("%d:add_mon %s %s %s",self.root._debug_id,self,i,callback)
 		return mon
@@ -730,7 +1338,8 @@ class EtcBase(object):
 		updlogger.debug("%d:del_mon %s %s",self.root._debug_id,self,token)
 		if isinstance(token,MonitorCallback):
 			token = token.i
-		self._later_mon.pop(token,None)
+		if self._later_mon is not None:
+			self._later_mon.pop(token,None)
 
 	async def _deleted(self):
 		#logger.debug("DELETE %s",self.path)
@@ -740,7 +1349,7 @@ class EtcBase(object):
 			await self._call_monitors()
 		else: # just for safety (and debugging)'s sake
 			self.is_new = None # pragma: no cover
-		self._ready.set() # sort of
+		self._set_ready() # sort of
 		p = self._parent
 		if p is None:
 			return # pragma: no cover
@@ -753,6 +1362,7 @@ class EtcBase(object):
 
 	async def _ext_delete(self, seq=None):
 		#logger.debug("DELETE_ %s",self.path)
+		self._forget()
 		if seq is not None:
 			self._seq = seq
 		p = self._parent
@@ -802,6 +1412,8 @@ def _make_name(_name,name):
 	return _name if type(name) is bool else tuple(chain(_name,name))
 
 class _EtcDir(EtcBase):
+	__slots__ = ('_data','_dirty')
+
 	def lookup(self, *_name, name=()):
 		"""\
 			Utility function to find a sub-node.
@@ -816,16 +1428,19 @@ class _EtcDir(EtcBase):
 			self = self.get(n, raw=True)
 		return self
 
-	async def subdir(self, *_name, name=(), create=None, recursive=None, wait=False):
+	async def subdir(self, *_name, name=(), create=None, recursive=None, wait=False, concurrency=None):
 		"""\
 			Utility function to find/create a sub-node.
 			@recursive decides what to do if the node thus encountered
 			hasn't been loaded before.
+			@concurrency is the max number of concurrent etcd reads
+			while doing that. The default is to load sequentially.
 
 			@_name and @name are chained. A boolean @name is ignored,
 			for compatibility with some tagging schemes.
 			"""
 		root=self.root
+		limit = None if not concurrency else asyncio.Semaphore(concurrency, loop=self._loop)
 		r = None
 		async def _end():
 			logger.debug("END1 %s",d)
@@ -839,7 +1454,7 @@ class _EtcDir(EtcBase):
 		else:
 			if isinstance(d,EtcAwaiter):
 				try:
-					d = await d
+					d = await d.load(recursive=recursive, limit=limit)
 				except (KeyError,etcd.EtcdKeyNotFound):
 					pass
 			if not isinstance(d,EtcAwaiter):
@@ -908,6 +1523,7 @@ class EtcAwaiter(_EtcDir):
 		self = parent._data.get(name,_NOTGIVEN)
 		if self is _NOTGIVEN:
 			self = object.__new__(cls)
+			self._dirty = None
 			super().__init__(self, parent=parent,pre=pre,name=name,_no_update_parent=True)
 			self._data = {}
 			assert name not in parent._data
@@ -942,7 +1558,7 @@ class EtcAwaiter(_EtcDir):
 	def __await__(self):
 		return self.load().__await__()
 
-	async def load(self,recursive=None, pre=None):
+	async def load(self,recursive=None, pre=None, limit=None):
 		if self._done is not None:
 			return self._done # pragma: no cover ## concurrency
 		root = self.root
@@ -959,7 +1575,7 @@ class EtcAwaiter(_EtcDir):
 				if self._done is not None:
 					return self._done
 				
-			obj = await p._new(parent=p,key=self.name,recursive=recursive, pre=pre, _fill=self)
+			obj = await p._new(parent=p,key=self.name,recursive=recursive, pre=pre, limit=limit, _fill=self)
 		except (KeyError,etcd.EtcdKeyNotFound):
 			del p._data[self.name]
 			raise
@@ -974,19 +1590,38 @@ class EtcAwaiter(_EtcDir):
 ##############################################################################
 
 class EtcXValue(EtcBase):
-	"""A value node, i.e. the leaves of the etcd tree."""
+	"""\
+		A value node, i.e. the leaves of the etcd tree.
+
+		If the class attribute `lazy` is set, values are decoded when
+		they're first accessed instead of when they arrive. Use this for
+		types with an expensive `_load`.
+		"""
+	__slots__ = ('_value',)
 	type = str
+	lazy = False
 	_is_dir = False
 
-	_seq = None
 	def __init__(self, pre=None,**kw):
 		super().__init__(pre=pre, **kw)
+		if self.lazy:
+			self._value = _Raw(pre.value)
+		else:
+			self._value = self._decode(pre.value)
+		self.updated(0)
+
+	def _decode(self, value):
 		try:
-			self._value = self._load(pre.value)
+			return self._load(value)
 		except ValueError:
-			logger.error("Wrong type: %s in %s" % (repr(pre.value), '/'.join(self.path),))
-			self._value = NotConverted(pre.value)
-		self.updated(0)
+			logger.error("Wrong type: %s in %s" % (repr(value), '/'.join(self.path),))
+			return NotConverted(value)
+
+	def _raw_value(self):
+		v = self._value
+		if isinstance(v,(_Raw,NotConverted)):
+			return v.value
+		return self._dump(v)
 
 	def __hash__(self):
 		return hash(self.path)
@@ -1006,36 +1641,43 @@ class EtcXValue(EtcBase):
 
 	def _get_value(self):
 		# TODO: no cover
-		if self._value is _NOTGIVEN: # pragma: no cover
+		v = self._value
+		if v is _NOTGIVEN: # pragma: no cover
 			raise RuntimeError("You did not sync")
-		return self._value
+		if type(v) is _Raw:
+			v = self._value = self._decode(v.value)
+		return v
 
 	def _set_value(self,value):
-		self.root.task(self._do_set,self._dump(value), _die=True)
-	async def _do_set(self,value):
-		await self.root._set(self.path,value, index=self._seq)
+		self.root._write_later(self.path,self._dump(value), node=self)
 
 	def _del_value(self):
-		self.root.task(self._do_del, _die=True)
-	async def _do_del(self):
-		await self.root._delete(self.path, index=self._seq)
+		self.root._write_later(self.path,_DELETE, node=self)
 
 	value = property(_get_value, _set_value, _del_value)
 	__delitem__ = _del_value # for EtcDir.delete
 
+	def _prepare(self, value, ext=False, force=False):
+		"""\
+			Check @value for .set(). Returns the string to write, or
+			_NOTGIVEN if the node already has that value.
+			"""
+		if ext:
+			self._load(value) # raises an error if wrong
+			return value
+		if not isinstance(value,(float,int)) or self.type not in (float,int):
+			assert isinstance(value,self.type), (value,self.type, '/'.join(self.path))
+		if not force and self.value is not None and value == self.value:
+			return _NOTGIVEN
+		return self._dump(value)
+
 	async def set(self, value, sync=True, ttl=None, ext=False, force=False):
 		root = self.root
 		if root is None:
 			return # pragma: no cover
-		if ext:
-			self._load(value)
-		else:
-			if not isinstance(value,(float,int)) or self.type not in (float,int):
-				assert isinstance(value,self.type), (value,self.type, '/'.join(self.path))
-		if not ext:
-			if not force and self.value is not None and value == self.value:
-				return
-			value = self._dump(value)
+		value = self._prepare(value, ext=ext, force=force)
+		if value is _NOTGIVEN:
+			return
 
 		r = await root._set(self.path, value, index=None if force else self._seq, ttl=ttl)
 
@@ -1059,9 +1701,21 @@ class EtcXValue(EtcBase):
 			An updated value arrives.
 			(It may be late.)
 			"""
+		old = self._value
 		if not (await super()._ext_update(pre)): # pragma: no cover
 			return
-		self._value = self._load(pre.value)
+		if self.lazy:
+			self._value = _Raw(pre.value)
+		else:
+			self._value = self._load(pre.value)
+		p = self._parent
+		if p is not None:
+			p = p()
+			c = getattr(p,'_changed',None)
+			if c is not None:
+				if type(old) is _Raw:
+					old = self._decode(old.value)
+				c.setdefault(self.name, old)
 
 	def __reduce__(self):
 		res = super().__reduce__()
@@ -1126,8 +1780,12 @@ class EtcDir(_EtcDir, MutableMapping):
 		Map lookup will return a leaf node's EtcValue node.
 		Access by attribute will return the value directly.
 		"""
+	__slots__ = ('_added','_deled')
+	_changed = None # name => old value, if somebody wants a ChangeSet
+	_gone = None # name => (old value, seq) of deleted children
 	_value = None
 	_is_dir = True
+	write_window = 50 # concurrent writes of .set(), .update()
 	update_delay = 1
 	max_update_delay = 5
 	added = ()
@@ -1140,11 +1798,10 @@ class EtcDir(_EtcDir, MutableMapping):
 		if max_update_delay is not None:
 			self.max_update_delay = max_update_delay
 		self._data = {}
+		self._dirty = None
 		self._added = set()
 		self._deled = set()
 		super().__init__(**kw)
-		if self._types_from_parent is None:
-			self._types_from_parent = (self.name and self.name[0] != ':')
 
 	def __iter__(self):
 		return iter(self._data.keys())
@@ -1195,18 +1852,73 @@ class EtcDir(_EtcDir, MutableMapping):
 
 	__getitem__ = get
 
-	def add_monitor(self, callback):
+	def add_monitor(self, callback, changes=False):
+		"""\
+			Add a monitor, see EtcBase.add_monitor().
+
+			If @changes is set, the callback gets a ChangeSet with
+			old and new values of this directory's direct children as
+			second argument. That record is collected as the changes
+			arrive, so only directories which have such a monitor pay
+			for it. It is also available as .changes while monitors run.
+			"""
+		if changes:
+			callback = _ChangeCallback(callback)
+			if self._changed is None:
+				self._changed = {}
+				self._gone = {}
 		res = super().add_monitor(callback)
-		if self._ready.is_set():
+		if self._ready is _READY:
 			self.added = set(self._data.keys())
 			self.deleted = set()
+			if changes:
+				self.changes = ChangeSet(added={ n:Change(None,self._change_value(v),v._seq)
+					for n,v in self._data.items() })
 			callback(self)
 		return res
 
+	@staticmethod
+	def _change_value(node):
+		if isinstance(node, EtcXValue):
+			return node.value
+		return node
+
+	def _changeset(self):
+		# Collect the changes recorded since the last call.
+		# A child that's been deleted and re-added counts as changed.
+		changed,self._changed = self._changed,{}
+		gone,self._gone = self._gone,{}
+		res = ChangeSet()
+		data = self._data
+		for n,(old,seq) in gone.items():
+			v = data.get(n)
+			if v is None:
+				res.deleted[n] = Change(old,None,seq)
+			else:
+				res.changed[n] = Change(old,self._change_value(v),v._seq)
+		for n in self.added:
+			if n in gone:
+				continue
+			v = data.get(n)
+			if v is not None:
+				res.added[n] = Change(None,self._change_value(v),v._seq)
+		for n,old in changed.items():
+			if n in res.added or n in gone:
+				continue
+			v = data.get(n)
+			if v is not None:
+				res.changed[n] = Change(old,self._change_value(v),v._seq)
+		return res
+
 	async def _call_monitors(self):
 		self.added,self._added = self._added,set()
 		self.deleted,self._deled = self._deled,set()
 		updlogger.debug("%d:CALL_MON %s add:%s del:%s",self.root._debug_id,self,self.added,self.deleted)
+		if self._changed is not None:
+			self.changes = self._changeset()
+			if not self._later_mon or not any(type(m.callback) is _ChangeCallback for m in self._later_mon.values()):
+				# the last change monitor is gone
+				self._changed = self._gone = None
 
 		await super()._call_monitors()
 
@@ -1253,12 +1965,12 @@ class EtcDir(_EtcDir, MutableMapping):
 				path += (key,)
 
 				if isinstance(val,dict):
-					root.task(root._set,self.path+path, None, prevExist=False, dir=True, _die=True)
+					root.task(root._set,self.path+path, None, prevExist=False, dir=True, _die=True, _lane='write')
 					for k,v in val.items():
 						t_set(path,k,v)
 				else:
 					t = self.subtype(path, dir=False, raw=False)
-					root.task(self._task_set,path, t._dump(val), _die=True)
+					root._write_later(self.path+path, t._dump(val))
 			t_set((),key, val)
 		else:
 			if isinstance(res,EtcXValue):
@@ -1271,15 +1983,7 @@ class EtcDir(_EtcDir, MutableMapping):
 				for k,v in val.items():
 					res[k] = v
 
-	async def _task_set(self, path,val):
-		#for p in path[:-1]:
-			#self = self[p]
-		#self = await self # in case it's an EtcAwaiter
-		res = await self.root._set(self.path+path, val)
-		#res = await self.set(path[-1], val, sync=False, ext=True)
-		return res
-
-	async def set(self, key,value, sync=True, replace=True, ext=False, force=False, **kw):
+	async def set(self, key,value, sync=True, replace=True, ext=False, force=False, window=None, **kw):
 		"""\
 			Update a node. This is the coroutine version of assignment.
 			Returns the operation's modification index.
@@ -1289,7 +1993,9 @@ class EtcDir(_EtcDir, MutableMapping):
 
 			If @value is a mapping, recursively add/update values.
 			No nodes are deleted! Set "replace" to False if you only want
-			to supply defaults.
+			to supply defaults. The individual writes are sent
+			concurrently, at most @window (default: .write_window) at a
+			time; the result is the highest modification index.
 
 			If @ext is set, the value passed is a string as seen by etcd.
 			This is used from the command line.
@@ -1299,52 +2005,45 @@ class EtcDir(_EtcDir, MutableMapping):
 			first.
 			"""
 		root = self.root
-		res = mod = None
+		ops = []
+		res = await self._set_ops(ops, key,value, replace=replace, ext=ext, force=force, **kw)
+		mod = await _pipeline(ops, window or self.write_window, self._loop)
+		if key is None:
+			res,amod = res
+			if mod is None:
+				mod = amod
+			res = res,mod
+		else:
+			res = mod
+
+		if sync and mod and root is not None:
+			await root.wait(mod)
+		return res
+
+	async def _set_ops(self, ops, key,value, replace=True, ext=False, force=False, **kw):
+		"""\
+			Check the data for .set() and add the required writes to @ops.
+			Values are checked before anything is written.
+
+			Appending (@key is None) happens immediately, as the new
+			key is needed; this returns a key,modIndex tuple.
+			"""
+		root = self.root
 		if key is not None and '/' in key:
 			key = tuple(k for k in key.split('/') if k != "")
 		if isinstance(key,(tuple,list)):
 			self = await self.subdir(key[:-1])
 			key = key[-1]
-		try:
-			if key is None:
-				raise KeyError
-			else:
-				sub = self._data[key]
-		except KeyError:
-			# new node. Send a "set" command for the data item.
-			# (or items if it's a dict)
-			async def t_set(path,keypath,key,value):
-				path += (key,)
+		sub = None if key is None else self._data.get(key,None)
+		if type(sub) is EtcAwaiter:
+			sub = await sub.load()
 
-				mod = None
-				if isinstance(value,dict):
-					if value:
-						for k,v in value.items():
-							r = await t_set(path,keypath,k,v)
-							if r is not None:
-								mod = r
-					else: # empty dict
-						r = await root._set(path, None, dir=True, **kw)
-						mod = r.modifiedIndex
-				else:
-					t = self.subtype(*path[keypath:], dir=False, raw=False)
-					if ext:
-						t._load(value) # raises an error if wrong
-					else:
-						if type(value) is int and t.type is float:
-							pass
-						else:
-							assert isinstance(value,t.type), (value,t.type, '/'.join(path))
-					r = await root._set(path, value if ext else t._dump(value), **kw)
-					mod = r.modifiedIndex
-				return mod
+		if sub is None:
 			if key is None:
 				if isinstance(value,dict):
 					r = await root._set(self.path, None, append=True, dir=True)
 					res = r.key.rsplit('/',1)[1]
-					mod = await t_set(self.path,len(self.path),res, value)
-					if mod is None:
-						mod = r.modifiedIndex # pragma: no cover
+					self._new_ops(ops, res, value, ext=ext, **kw)
 				else:
 					t = self.subtype(('0',), dir=False, raw=False)
 					if ext:
@@ -1353,25 +2052,53 @@ class EtcDir(_EtcDir, MutableMapping):
 						assert isinstance(value,t.type), (value,t.type, '/'.join(self.path))
 					r = await root._set(self.path, value if ext else t._dump(value), append=True, **kw)
 					res = r.key.rsplit('/',1)[1]
-					mod = r.modifiedIndex
-				res = res,mod
-			else:
-				res = mod = await t_set(self.path,len(self.path),key, value)
+				return res,r.modifiedIndex
+			self._new_ops(ops, key, value, ext=ext, **kw)
+
+		elif isinstance(sub,EtcXValue):
+			if isinstance(value,dict):
+				raise ValueError("Cannot replace a terminal node with a mapping",self.path)
+			if replace:
+				value = sub._prepare(value, ext=ext, force=force)
+				if value is not _NOTGIVEN:
+					ops.append(partial(self._set_leaf, sub.path, value, index=None if force else sub._seq, **kw))
 		else:
-			if isinstance(sub,EtcXValue):
-				if isinstance(value,dict):
-					raise ValueError("Cannot replace a terminal node with a mapping",self.path)
-				if replace:
-					res = mod = await sub.set(value, ext=ext, force=force, sync=False, **kw)
+			if not isinstance(value,dict):
+				raise ValueError("Cannot replace a mapping with a terminal node",self.path)
+			for k,v in value.items():
+				await sub._set_ops(ops, k,v, replace=replace, ext=ext, force=force, **kw)
+
+	def _new_ops(self, ops, key, value, ext=False, **kw):
+		"""\
+			Add the writes which create the new node @key, with @value, to
+			@ops. (Or nodes if it's a dict.) etcd creates intermediate
+			directories along with their first entry, so only empty
+			directories need a write.
+			"""
+		def t_set(path,keypath,key,value):
+			path += (key,)
+
+			if isinstance(value,dict):
+				if value:
+					for k,v in value.items():
+						t_set(path,keypath,k,v)
+				else: # empty dict
+					ops.append(partial(self._set_leaf, path, None, dir=True, **kw))
 			else:
-				if not isinstance(value,dict):
-					raise ValueError("Cannot replace a mapping with a terminal node",self.path)
-				for k,v in value.items():
-					res = mod = await sub.set(k,v, replace=replace, ext=ext, force=force, sync=False, **kw)
+				t = self.subtype(*path[keypath:], dir=False, raw=False)
+				if ext:
+					t._load(value) # raises an error if wrong
+				else:
+					if type(value) is int and t.type is float:
+						pass
+					else:
+						assert isinstance(value,t.type), (value,t.type, '/'.join(path))
+				ops.append(partial(self._set_leaf, path, value if ext else t._dump(value), **kw))
+		t_set(self.path,len(self.path),key, value)
 
-		if sync and mod and root is not None:
-			await root.wait(mod)
-		return res
+	async def _set_leaf(self, path, value, **kw):
+		r = await self.root._set(path, value, **kw)
+		return r.modifiedIndex
 
 	def __delitem__(self, key=_NOTGIVEN):
 		"""\
@@ -1385,19 +2112,91 @@ class EtcDir(_EtcDir, MutableMapping):
 			res = self._data[key]
 			res.__delitem__()
 			return
-		self.root.task(self._delitem, _die=True)
+		self.root.task(self._delitem, _die=True, _lane='write')
 
 	async def _delitem(self):
 		await self.root._delete(self.path,dir=True, index=self._seq)
 
-	async def update(self, d1={}, _sync=True, **d2):
-		mod = None
+	async def update(self, d1={}, _sync=True, _window=None, **d2):
+		"""\
+			Set multiple values, see .set(). The writes are pipelined,
+			at most @_window at a time.
+			Returns the highest modification index.
+			"""
+		ops = []
 		for k,v in chain(d1.items(),d2.items()):
-			mod = await self.set(k,v, sync=False)
+			await self._set_ops(ops, k,v)
+		mod = await _pipeline(ops, _window or self.write_window, self._loop)
 		if _sync and mod:
 			root = self.root
-			if root:
+			if root is not None:
 				await root.wait(mod)
+		return mod
+
+	async def replace(self, data, sync=True, ext=False, window=None):
+		"""\
+			Make this directory's content equal to the mapping @data.
+			Returns the highest modification index, or None if nothing
+			needed to change.
+
+			The difference is computed against the local tree, so only
+			changed keys cost a round trip. (Unloaded subdirectories which
+			@data descends into are loaded, though.) Values are written
+			and deleted with their node's modification index as prevIndex;
+			etcd doesn't support that for directories, so those are
+			removed unconditionally. The writes are pipelined, see .set().
+
+			All values are checked before anything is written. However,
+			if a write fails (typically with EtcdCompareFailed because
+			somebody else changed a value), the writes which already
+			happened are not undone: the result is partial.
+			"""
+		root = self.root
+		if root is None:
+			return # pragma: no cover
+		ops = []
+		await self._replace_ops(ops, data, ext=ext)
+		mod = await _pipeline(ops, window or self.write_window, self._loop)
+		if sync and mod:
+			await root.wait(mod)
+		return mod
+
+	async def _replace_ops(self, ops, data, ext=False):
+		if not isinstance(data,dict):
+			raise ValueError("Cannot replace a mapping with a terminal node",self.path)
+		for k,sub in list(self._data.items()):
+			if k not in data:
+				ops.append(partial(self._del_sub, sub))
+		for k,v in data.items():
+			sub = self._data.get(k,None)
+			if type(sub) is EtcAwaiter:
+				sub = await sub.load()
+			if sub is None:
+				await self._set_ops(ops, k,v, ext=ext)
+			elif isinstance(sub,EtcXValue) == isinstance(v,dict):
+				# can't overwrite a value with a directory or vice versa
+				new = []
+				self._new_ops(new, k, v, ext=ext)
+				ops.append(partial(self._swap_sub, sub, new))
+			elif isinstance(sub,EtcDir):
+				await sub._replace_ops(ops, v, ext=ext)
+			else:
+				v = sub._prepare(v, ext=ext)
+				if v is _NOTGIVEN or (ext and sub._dump(sub.value) == v):
+					continue
+				ops.append(partial(self._set_leaf, sub.path, v, index=sub._seq))
+
+	async def _del_sub(self, sub):
+		if isinstance(sub,EtcXValue):
+			return (await sub.delete(sync=False))
+		r = await self.root._delete(sub.path, dir=True, recursive=True)
+		return r.modifiedIndex
+
+	async def _swap_sub(self, sub, ops):
+		# delete @sub, then run the writes which create its replacement
+		mod = await self._del_sub(sub)
+		res = await _pipeline(ops, self.write_window, self._loop)
+		return mod if res is None else res
 
 	def throw_away(self):
 		"""Delete this node, replacing it with an EtcAwaiter.
@@ -1437,6 +2236,11 @@ class EtcDir(_EtcDir, MutableMapping):
 		"""Called by the child to tell us that it vanished"""
 		node = self._data.pop(child.name)
 		self._deled.add(child.name)
+		if self._changed is not None:
+			old = self._changed.pop(child.name, _NOTGIVEN)
+			if old is _NOTGIVEN:
+				old = self._change_value(node)
+			self._gone.setdefault(child.name, (old, node._seq))
 		await node._deleted()
 
 	# The following code implements type lookup.
@@ -1476,26 +2280,34 @@ class EtcDir(_EtcDir, MutableMapping):
 			This method is used for looking up value conversions.
 			Thus, value types should never depend on non-path data.
 
-			TODO: add a cache with a coalesced _types list.
+			Lookups which only depend on class-level registrations (or on
+			the root's) are cached in the root, see EtcRoot._subtype_cache.
 			"""
 		if dir is None:
 			if pre is not None:
 				dir = pre.dir
 			else:
 				raise ReloadData
-		types = self._types
-		if types is not None:
-			cls = types.lookup(*path,dir=dir,raw=True)
-			if cls is not None and cls.type is not None:
-				return cls if raw else cls.type[dir]
-		for sup in type(self).mro():
-			types = sup.__dict__.get('_types',None)
-			if types is None:
-				continue
-			cls = types.lookup(*path,dir=dir,raw=True)
-			if cls is not None and cls.type is not None:
-				return cls if raw else cls.type[dir]
-		p = self.parent if self._types_from_parent else None
+		path = _types_path(path)
+		root = self.root
+		if root is None or (self is not root and self._types is not type(self)._types):
+			# instance-specific types: can't cache
+			cls = self._subtype_local(path,dir)
+		else:
+			if root._subtype_gen != _types_gen:
+				root._subtype_cache.clear()
+				root._subtype_gen = _types_gen
+			key = (type(self), self is root, _types_pattern(path), dir)
+			try:
+				cls = root._subtype_cache[key]
+			except KeyError:
+				cls = root._subtype_cache[key] = self._subtype_local(path,dir)
+		if cls is not None:
+			return cls if raw else cls.type[dir]
+		tp = self._types_from_parent
+		if tp is None:
+			tp = self.name and self.name[0] != ':'
+		p = self.parent if tp else None
 		if p is None:
 			if not default:
 				return None
@@ -1504,7 +2316,51 @@ class EtcDir(_EtcDir, MutableMapping):
 				res = DummyType(res)
 			return res
 		return p.subtype(*((self.name,)+path),dir=dir,pre=pre,recursive=recursive,raw=raw)
-	
+
+	def subtypes(self, children, recursive=None):
+		"""\
+			Decide which types to use for a whole directory listing.
+			@children is an iterable of EtcdResult entries for direct
+			children of this node, as returned by reading it.
+			@recursive is True if they were read recursively.
+
+			Returns a (types,reload) tuple. @types maps the names of
+			children to (entry,EtcdResult) tuples; the entry is whatever
+			.subtype(…,raw=True) returns for them. @reload lists the names
+			of children that can't be classified without their data.
+			"""
+		types = {}
+		reload = []
+		for c in children:
+			n = c.name
+			try:
+				t = self.subtype(n,dir=c.dir,pre=(c if recursive or not c.dir else None),recursive=recursive, raw=True)
+			except ReloadData:
+				reload.append(n)
+			else:
+				types[n] = (t,c)
+		return types,reload
+
+	def _subtype_local(self, path, dir):
+		"""\
+			Look up @path in this node's registrations, i.e. the
+			instance's and those of its class hierarchy.
+			Returns the EtcTypes entry, or None.
+			"""
+		types = self._types
+		if types is not None:
+			cls = types.lookup(path,dir=dir,raw=True)
+			if cls is not None and cls.type is not None:
+				return cls
+		for sup in type(self).mro():
+			types = sup.__dict__.get('_types',None)
+			if types is None:
+				continue
+			cls = types.lookup(path,dir=dir,raw=True)
+			if cls is not None and cls.type is not None:
+				return cls
+		return None
+
 	@hybridmethod
 	def registrations(self):
 		"""\
@@ -1537,6 +2393,33 @@ class DummyType:
 
 ##############################################################################
 
+class _Lane:
+	"""A priority class for EtcRoot.task(), see EtcRoot.lanes"""
+	__slots__ = ('name','pri','limit','depth','strict','running','queue')
+
+	def __init__(self, name, pri=0, limit=None, depth=None, strict=False):
+		self.name = name
+		self.pri = pri
+		self.limit = limit
+		self.depth = depth
+		self.strict = strict
+		self.running = 0
+		self.queue = deque()
+
+	def __repr__(self): # pragma: no cover
+		return "<lane %s:%d %d/%s q=%d>" % (self.name,self.pri,self.running,self.limit,len(self.queue))
+
+class _PendingWrite:
+	"""Per-key state of EtcRoot._write_later()"""
+	__slots__ = ('value','node','busy','timer','last')
+
+	def __init__(self):
+		self.value = _NOTGIVEN # what to write next
+		self.node = None # supplies the prevIndex
+		self.busy = False # a write is in flight
+		self.timer = False # a write is scheduled
+		self.last = None # modifiedIndex of our last write
+
 class _DummyFuture:
 	def done(self):
 		return True
@@ -1558,24 +2441,67 @@ class EtcRoot(EtcDir):
 	_parent = None
 	name = ''
 	_types = None
+	_propagate_updates = False
 	last_mod = None
 	closed = False
 	job_error = None
 	_debug_id = 0
-
-	def __init__(self,conn,watcher=None,key=(),types=None, update_delay=None, max_update_delay=None, **kw):
+	_subtype_gen = None
+	timer_tick = 0.01 # timers due this close together run together
+	_timer_handle = None
+	_timer_at = None
+	_stall_timer = None
+	_progress = None
+	write_delay = 0 # collect assignments to the same key for this long
+	optimistic = False # apply our own writes before the watcher sees them
+	_subs = None # etcd._Patterns, for subscribe()
+	_sub_cbs = None
+	_streams = None # WeakSet of ChangeStream
+
+	# Job priority classes for .task(). Lower 'pri' runs first. 'limit'
+	# caps the number of concurrent jobs, 'depth' the number of jobs
+	# waiting for a slot (task() raises asyncio.QueueFull beyond that).
+	# While a 'strict' lane has jobs, no lower-priority job is started,
+	# so its jobs must never wait for those: making the watch lane strict
+	# deadlocks subscription callbacks or 'block' change streams which
+	# do that.
+	lanes = {
+		'watch': dict(pri=0), # applying etcd events
+		'update': dict(pri=1), # monitors
+		'load': dict(pri=1),
+		'default': dict(pri=2),
+		'write': dict(pri=3, limit=100), # write-back of assigned values
+	}
+
+	def __init__(self,conn,watcher=None,key=(),types=None, update_delay=None, max_update_delay=None, lanes=None, optimistic=None, **kw):
 		global debug_id; debug_id+=1
 		self._debug_id = debug_id
 		self._conn = conn
 		self._watcher = watcher
-		self.path = key
+		self.path = EtcPath.of(key)
 		self._loop = conn._loop
-		self._q = asyncio.Queue(loop=self._loop)
+		self._jobs = 0
+		self._barriers = []
+		self._wbuf = {}
+		if optimistic is not None:
+			self.optimistic = optimistic
+		self._overlay = {} # etcd key => modifiedIndex of a pending local write
+		cf = self.lanes
+		if lanes is not None:
+			cf = dict(cf)
+			cf.update(lanes)
+		self._lanes = {n:_Lane(n,**c) for n,c in cf.items()}
+		self._lane_order = sorted(self._lanes.values(), key=lambda l:l.pri)
+		self._strict = [l for l in self._lane_order if l.strict]
+		self._running = set()
 		self._err_q = asyncio.Queue(loop=self._loop)
 		if types is None:
 			from .etcd import EtcTypes
 			types = EtcTypes()
 		self._types = types
+		self._subtype_cache = {}
+		self._timers = []
+		self._timers_dead = 0
 		self._env = Env()
 		if update_delay is not None:
 			self.update_delay = update_delay
@@ -1583,96 +2509,351 @@ class EtcRoot(EtcDir):
 			self.max_update_delay = max_update_delay
 		self._conn._trees.add(self)
 		super().__init__(**kw)
-		self._propagate_updates = False
-		self._job = asyncio.ensure_future(self._run(), loop=self._loop)
 		runlogger.debug("%d:init %s",self._debug_id,self)
 
-	async def _run(self):
-		jobs = set()
-		dones = set()
-		qr = asyncio.ensure_future(self._q.get(), loop=self._loop)
-		jobs.add(qr)
+	def task(self, p,*a, _die=False, _lane='default', **k):
+		"""\
+			Run @p(*a,**k) as a job of this tree, in lane @_lane
+			(see .lanes).
+
+			Returns a future for the result, or None if @_die is set;
+			errors of those jobs are raised by the next .wait().
+			The future is cancelled if the job doesn't finish within
+			max_update_delay+2*update_delay; the job itself continues.
+			Running jobs only get cancelled when none of them made any
+			progress for that long.
+			"""
+		runlogger.debug("%d:Enq %s %s %s %s",self._debug_id, _lane, p,a,k)
+		if self.closed:
+			raise asyncio.CancelledError
+		lane = self._lanes[_lane]
+		if not lane.queue and self._may_start(lane):
+			f = None if _die else asyncio.Future(loop=self._loop)
+			self._start(lane, f,p,a,k)
+		else:
+			if lane.depth is not None and len(lane.queue) >= lane.depth:
+				raise asyncio.QueueFull(_lane)
+			f = None if _die else asyncio.Future(loop=self._loop)
+			lane.queue.append((f,p,a,k))
+		if f is not None:
+			t = self._call_later(self.max_update_delay+2*self.update_delay, self._job_timeout, f)
+			f.add_done_callback(lambda _: t.cancel())
+		return f
 
-		try:
-			while jobs:
-				if len(jobs) > (qr is not None):
-					timeout = self.max_update_delay+2*self.update_delay
-				else:
-					timeout = None
-					for d in dones:
-						runlogger.debug("%d:done- %s",self._debug_id, d)
-						d.set_result(None)
-					dones = set()
-				runlogger.debug("%d:wait %d %s %s",self._debug_id, len(jobs), timeout, jobs)
-				done,jobs = await asyncio.wait(jobs, timeout=timeout, loop=self._loop, return_when=asyncio.FIRST_COMPLETED)
-				runlogger.debug("%d:res %d %d",self._debug_id, len(done),len(jobs))
-
-				if not done: # no progress due to timeout
-					runlogger.debug("%d:timeout",self._debug_id)
-
-					for j in jobs:
-						if j is qr:
-							continue
-						runlogger.debug("%d:timeout:%d",self._debug_id, j.__debug_id)
-						j.cancel()
-					continue
+	@staticmethod
+	def _job_timeout(f):
+		if not f.done():
+			f.cancel()
 
-				for j in done:
-					if j is qr:
-						continue
-					runlogger.debug("%d:end:%d",self._debug_id, j.__debug_id)
-					try:
-						res = j.result()
-					except Exception as exc:
-						if j.__f is not None:
-							runlogger.exception("%d:Set error",self._debug_id)
-							j.__f.set_exception(exc)
-						else:
-							runlogger.exception("%d:Queue error",self._debug_id)
-							await self._err_q.put(exc)
-					else:
-						runlogger.debug("%d:Result %s",self._debug_id, res)
-						if j.__f:
-							j.__f.set_result(res)
-
-				if qr is not None and qr.done():
-					qr = qr.result()
-					if qr is not None:
-						if isinstance(qr,asyncio.Future):
-							runlogger.debug("%d:done+ %s",self._debug_id, qr)
-							dones.add(qr)
-						else:
-							f,p,a,k = qr
-							global debug_id; debug_id+=1
-							d_id = debug_id
-							runlogger.debug("%d:run:%d %s %s %s",self._debug_id,d_id, p,a,k)
-
-							j = asyncio.ensure_future(p(*a,**k), loop=self._loop)
-							j.__f = f
-							j.__debug_id = d_id
-							jobs.add(j)
-						qr = asyncio.ensure_future(self._q.get(), loop=self._loop)
-						jobs.add(qr)
+	def _may_start(self, lane):
+		if lane.limit is not None and lane.running >= lane.limit:
+			return False
+		for l in self._strict:
+			if l.pri >= lane.pri:
+				break
+			if l.running or l.queue:
+				return False
+		return True
 
-		except BaseException:
-			logger.exception("ow")
-			raise
-		return
+	def _dispatch(self):
+		# start whatever queued jobs may run now
+		for lane in self._lane_order:
+			q = lane.queue
+			while q and self._may_start(lane):
+				self._start(lane, *q.popleft())
+
+	def _start(self, lane, f,p,a,k):
+		global debug_id; debug_id+=1
+		d_id = debug_id
+		runlogger.debug("%d:run:%d %s %s %s",self._debug_id,d_id, p,a,k)
+
+		j = asyncio.ensure_future(p(*a,**k), loop=self._loop)
+		self._jobs += 1
+		lane.running += 1
+		self._running.add(j)
+		j.add_done_callback(partial(self._job_done, lane, f, d_id))
+
+		self._progress = self._loop.time()
+		if self._stall_timer is None:
+			self._stall_timer = self._call_later(self.max_update_delay+2*self.update_delay, self._check_stall)
+
+	def _job_done(self, lane, f, d_id, j):
+		self._jobs -= 1
+		lane.running -= 1
+		self._running.discard(j)
+		self._progress = self._loop.time()
+		runlogger.debug("%d:end:%d",self._debug_id, d_id)
+		if j.cancelled():
+			exc = asyncio.CancelledError()
+		else:
+			exc = j.exception()
+		if exc is not None:
+			if f is not None:
+				runlogger.error("%d:Set error",self._debug_id, exc_info=exc)
+				if not f.done():
+					if j.cancelled():
+						f.cancel()
+					else:
+						f.set_exception(exc)
+			else:
+				runlogger.error("%d:Queue error",self._debug_id, exc_info=exc)
+				self._err_q.put_nowait(exc)
+		else:
+			res = j.result()
+			runlogger.debug("%d:Result %s",self._debug_id, res)
+			if f is not None and not f.done():
+				f.set_result(res)
+
+		self._dispatch()
+		if not self._jobs and self._barriers:
+			bs,self._barriers = self._barriers,[]
+			for b in bs:
+				runlogger.debug("%d:done- %s",self._debug_id, b)
+				if not b.done():
+					b.set_result(None)
+
+	def _check_stall(self):
+		# Cancel the running jobs if none of them started or finished
+		# for max_update_delay+2*update_delay, like the old runner did.
+		self._stall_timer = None
+		if not self._running:
+			return
+		timeout = self.max_update_delay+2*self.update_delay
+		t = self._progress+timeout - self._loop.time()
+		if t > 0:
+			self._stall_timer = self._call_later(t, self._check_stall)
+			return
+		runlogger.debug("%d:timeout",self._debug_id)
+		for j in list(self._running):
+			j.cancel()
 
-	def task(self, p,*a, _die=False, **k):
-		runlogger.debug("%d:Enq %s %s %s",self._debug_id, p,a,k)
+	def _write_later(self, path, value, node=None):
+		"""\
+			Write @value (or delete, if it's _DELETE) to @path, for
+			synchronous assignment.
+
+			Writes to the same path are buffered for .write_delay seconds
+			and collapse to the latest value. Only one write per path is
+			in flight; values assigned meanwhile are written when it
+			completes, using its modifiedIndex as prevIndex.
+			If @node is given, its _seq is the prevIndex of the first write.
+			"""
 		if self.closed:
 			raise asyncio.CancelledError
-		f = None if _die else asyncio.Future(loop=self._loop)
-		self._q.put_nowait((f,p,a,k))
-
-		if f is not None:
-			def timer(f):
-				if not f.done():
-					f.cancel()
-			self._loop.call_later(self.max_update_delay+2*self.update_delay, timer,f)
+		w = self._wbuf.get(path,None)
+		if w is None:
+			w = self._wbuf[path] = _PendingWrite()
+		w.value = value
+		if node is not None:
+			w.node = node
+		if not w.busy and not w.timer:
+			w.timer = True
+			self._call_later(self.write_delay, self._write_start, path)
+
+	def _write_start(self, path):
+		w = self._wbuf.get(path,None)
+		if w is None or w.busy or w.value is _NOTGIVEN:
+			return
+		w.timer = False
+		if self.closed:
+			del self._wbuf[path]
+			return
+		value,w.value = w.value,_NOTGIVEN
+		try:
+			self.task(self._write_one, path,w,value, _die=True, _lane='write')
+		except asyncio.QueueFull:
+			# the lane is full: keep the value, retry shortly
+			w.value = value
+			w.timer = True
+			self._call_later(self.timer_tick, self._write_start, path)
+			return
+		w.busy = True
+
+	async def _write_one(self, path,w,value):
+		index = None
+		if w.node is not None:
+			index = w.node._seq
+			if w.last is not None and (index is None or index < w.last):
+				index = w.last
+		ok = False
+		try:
+			if value is _DELETE:
+				r = await self._delete(path, index=index)
+			else:
+				r = await self._set(path, value, index=index)
+			w.last = r.modifiedIndex
+			ok = True
+		finally:
+			w.busy = False
+			if ok and w.value is not _NOTGIVEN:
+				self._write_start(path)
+			elif not w.timer:
+				# done, or failed: drop what's been collected
+				del self._wbuf[path]
+
+	def _flush_writes(self):
+		"""Start all buffered writes now"""
+		for path,w in list(self._wbuf.items()):
+			if w.timer:
+				self._write_start(path)
+
+	def _barrier(self):
+		"""A future that triggers when no jobs are running"""
+		f = asyncio.Future(loop=self._loop)
+		if self._jobs:
+			self._barriers.append(f)
+		else:
+			f.set_result(None)
 		return f
 
+	def _call_later(self, delay, callback, *args):
+		"""\
+			Like loop.call_later(), but all of this tree's update timers
+			share a heap and a single loop handle, so re-arming or
+			cancelling one of them is cheap.
+			"""
+		t = _Timer(self, self._loop.time()+delay, callback, args)
+		heapq.heappush(self._timers, t)
+		if self._timer_at is None or t.when < self._timer_at:
+			self._schedule_timers()
+		return t
+
+	def _schedule_timers(self):
+		if self._timer_handle is not None:
+			self._timer_handle.cancel()
+			self._timer_handle = None
+			self._timer_at = None
+		if not self._timers or self.closed:
+			return
+		self._timer_at = self._timers[0].key
+		self._timer_handle = self._loop.call_at(self._timer_at, self._run_timers)
+
+	def _run_timers(self):
+		self._timer_handle = None
+		self._timer_at = None
+		timers = self._timers
+		now = self._loop.time()+self.timer_tick
+		due = []
+		while timers and timers[0].key <= now:
+			t = heapq.heappop(timers)
+			if t.callback is None:
+				self._timers_dead -= 1
+			elif t.when > now: # postponed
+				t.key = t.when
+				heapq.heappush(timers, t)
+			else:
+				due.append(t)
+		if self._timers_dead > 100 and self._timers_dead > len(timers)//2:
+			self._timers = [t for t in timers if t.callback is not None]
+			heapq.heapify(self._timers)
+			self._timers_dead = 0
+		for t in due:
+			cb,t.callback = t.callback,None
+			try:
+				cb(*t.args)
+			except Exception:
+				logger.exception("Timer %s",cb)
+		self._schedule_timers()
+
+	def subscribe(self, pattern, callback):
+		"""\
+			Call @callback(path,event) for each change from etcd whose key
+			matches @pattern. The pattern uses EtcTypes' wildcards: '*'
+			matches one path element (but not one starting with a
+			colon, use ':*' for those); '**' matches one or more elements.
+
+			@path is a tuple of names relative to this root; @event is
+			the etcd result which caused the change. The callback runs
+			after the tree has been updated; it may return an awaitable.
+			Changes which are discovered by re-reading the tree, after
+			etcd has discarded too many events, are not reported.
+
+			Returns a token with a .cancel() method.
+			"""
+		if self._subs is None:
+			from .etcd import _Patterns
+			self._subs = _Patterns()
+			self._sub_cbs = {}
+		if isinstance(pattern,str):
+			pattern = pattern.split('/')
+		pattern = tuple(pattern)
+		entry = self._subs.step(pattern)
+		sub = Subscription(self,pattern,entry,callback)
+		cbs = self._sub_cbs.get(entry,None)
+		if cbs is None:
+			cbs = self._sub_cbs[entry] = []
+		cbs.append(sub)
+		return sub
+
+	def _unsubscribe(self, sub):
+		cbs = self._sub_cbs.get(sub.entry,None)
+		if cbs is not None and sub in cbs:
+			cbs.remove(sub)
+			if not cbs:
+				del self._sub_cbs[sub.entry]
+				self._subs.prune(sub.pattern, self._sub_cbs)
+
+	def changes(self, prefix=(), since=None, maxlen=1000, overflow='drop'):
+		"""\
+			Return an async iterator of ChangeEvent objects for the changes
+			below @prefix (a tuple of names, or a string) that this tree's
+			watcher processes.
+
+			If @since is given, only report changes after that
+			modifiedIndex. Changes which the tree has already seen are
+			replayed from etcd's event history; if that fails or takes
+			longer than ChangeStream.backfill_timeout per event, the
+			stream raises the error.
+
+			At most @maxlen events are buffered. If the buffer is full,
+			@overflow decides what happens:
+			* 'drop' (default): the oldest event is discarded and counted
+			  in .dropped;
+			* 'collapse': an event replaces the buffered one for the same
+			  path (keeping its old value); new paths are dropped;
+			* 'block': the watcher waits for the consumer. This stalls
+			  all updates of the tree, so only use it if the consumer is
+			  guaranteed to keep reading and doesn't wait for the tree.
+
+			The stream ends when the tree is closed or the stream's
+			.close() method is called. It is not kept alive by the tree.
+			If events got lost, because etcd's history no longer covers
+			them, the stream raises EtcdEventIndexCleared after the
+			events it has buffered.
+			"""
+		if self._watcher is None:
+			raise RuntimeError("This tree is not watched")
+		if isinstance(prefix,str):
+			prefix = [p for p in prefix.split('/') if p != '']
+		st = ChangeStream(self, prefix=prefix, since=since, maxlen=maxlen, overflow=overflow)
+		if self._streams is None:
+			self._streams = weakref.WeakSet()
+		self._streams.add(st)
+		return st
+
+	async def _notify(self, path, event):
+		# Called by the watcher after applying @event
+		if self._streams:
+			ev = None
+			for st in list(self._streams):
+				if st._wanted(path):
+					if ev is None:
+						ev = ChangeEvent._from(path, event)
+					await st._add(ev)
+		if not self._sub_cbs:
+			return
+		for entry in self._subs.matches(path):
+			for sub in self._sub_cbs.get(entry,()):
+				try:
+					res = sub(path,event)
+					try:
+						await res
+					except TypeError:
+						pass
+				except Exception as exc:
+					updlogger.debug("%d:Exc %s",self._debug_id, sub.callback, exc_info=exc)
+					await self._err_q.put(exc)
+
 	@property
 	def env(self):
 		return self._env
@@ -1701,13 +2882,19 @@ class EtcRoot(EtcDir):
 		from .etcd import WatchStopped
 
 		logger.debug("%d:Closing A",self._debug_id)
+		if self._streams:
+			# first, so that a stalled consumer can't block the watcher
+			for st in list(self._streams):
+				st.close()
 		try:
 			await self.wait(tasks=True)
 		except WatchStopped:
 			logger.exception("Not Watching")
 		logger.debug("%d:Closing B",self._debug_id)
 		self.closed = True
-		self._q.put_nowait(None)
+		self._schedule_timers()
+		self._timers = [] # these refer back to us
+		self._stall_timer = None
 
 		w,self._watcher = self._watcher,None
 		if w is not None:
@@ -1719,7 +2906,7 @@ class EtcRoot(EtcDir):
 			logger.exception("Close: deferred exception", exc_info=exc)
 
 		logger.debug("%d:Closing D",self._debug_id)
-		await self._job
+		await self._barrier()
 		logger.debug("%d:Closing E",self._debug_id)
 		self._conn._trees.remove(self)
 
@@ -1735,11 +2922,12 @@ class EtcRoot(EtcDir):
 		if self.last_mod is not None and (mod is None or mod < self.last_mod):
 			mod = self.last_mod
 		while self._watcher is not None:
-			if tasks:
-				f = asyncio.Future(loop=self._loop)
-				self._q.put_nowait(f)
+			while tasks:
 				logger.debug("%d:DeferWait T %s",self._debug_id,mod)
-				await f
+				self._flush_writes()
+				await self._barrier()
+				if not any(w.timer for w in self._wbuf.values()):
+					break # no write waiting for a slot
 
 			logger.debug("%d:DeferWait sync",self._debug_id)
 			more = await self._watcher.sync(mod, force=tasks)
@@ -1757,6 +2945,72 @@ class EtcRoot(EtcDir):
 		logger.debug("%d:DeferWait end %s",self._debug_id,mod)
 		return mod
 
+	async def snapshot(self, dest):
+		"""\
+			Save the current state of this tree to @dest, which is either
+			a file name or a file-like object.
+
+			Lazily-loaded subtrees are read first. The snapshot records the
+			etcd index the tree is consistent with, so `EtcClient.tree()`
+			can rebuild it from the file and resume watching from there.
+			Subtrees which were read at a later index record that, so that
+			older events don't get applied to them after the restart.
+
+			A file is written by a worker thread; writing to a file-like
+			object happens in the event loop and blocks it.
+			"""
+		w = self._watcher
+		if w is None:
+			raise RuntimeError("A static tree can't be snapshotted")
+		while True:
+			await self.wait()
+			todo = [self]
+			aw = []
+			while todo:
+				for v in todo.pop()._data.values():
+					if isinstance(v,EtcAwaiter):
+						aw.append(v)
+					elif isinstance(v,EtcDir):
+						todo.append(v)
+			if not aw:
+				break
+			for v in aw:
+				try:
+					pre = await self._conn.read(v.path, recursive=True)
+				except EtcdKeyNotFound:
+					pre = None # load() cleans up
+				with suppress(KeyError,EtcdKeyNotFound):
+					await v.load(recursive=True, pre=pre)
+					if pre is not None:
+						w._add_floor(self._conn._extkey(v.path), pre.etcd_index)
+
+		# no more waiting from here on
+		index = w.last_applied
+		data = {'key': self._conn._extkey(self.path), 'index': index,
+			'floors': {k:i for k,i in w._floors.items() if i > index},
+			'tree': self._snapshot_node(self)}
+		if not isinstance(dest,str):
+			json.dump(data, dest, separators=(',',':'))
+			return
+		def write():
+			tmp = dest+'.tmp'
+			with open(tmp,'w') as f:
+				json.dump(data, f, separators=(',',':'))
+			os.replace(tmp,dest)
+		await self._loop.run_in_executor(None, write)
+
+	@staticmethod
+	def _snapshot_node(node):
+		ttl = node._get_ttl()
+		if ttl is not None:
+			ttl = max(int(ttl),1)
+		res = [node.name, node._cseq, node._seq, ttl]
+		if isinstance(node,EtcDir):
+			res.append([EtcRoot._snapshot_node(v) for v in node._data.values()])
+		else:
+			res.append(node._raw_value())
+		return res
+
 	def __reduce__(self):
 		res = super().__reduce__()
 		res[2]['debug_id'] = self._debug_id
@@ -1776,12 +3030,19 @@ class EtcRoot(EtcDir):
 		self._kill()
 	def _kill(self, ignore_q=True):
 		logger.debug("%d:Force-Closing %s",self._debug_id,repr(self))
-		self.closed = True
-		try:
-			self._conn._trees.remove(self)
-		except KeyError:
-			pass
-		if not ignore_q and self._q.qsize():
+		if self._timer_handle is not None:
+			self._timer_handle.cancel()
+			self._timer_handle = None
+		if not self.closed:
+			# close() already did this. Don't remove another tree
+			# at the same path, which compares equal: timers in the
+			# heap refer to their tree, so __del__ may run much later.
+			self.closed = True
+			try:
+				self._conn._trees.remove(self)
+			except KeyError:
+				pass
+		if not ignore_q and self._jobs:
 			import pdb;pdb.set_trace()
 
 		w,self._watcher = self._watcher,None
@@ -1799,17 +3060,42 @@ class EtcRoot(EtcDir):
 
 	async def _set(self, *a,**k):
 		r = await self._conn.set(*a,**k)
-		self.last_mod = r.modifiedIndex
+		if self.last_mod is None or self.last_mod < r.modifiedIndex:
+			self.last_mod = r.modifiedIndex
+		if self.optimistic:
+			await self._apply_local(r)
 		return r
 
 	async def _delete(self, path,*a,**k):
 		try:
 			r = await self._conn.delete(path,*a,**k)
-			self.last_mod = r.modifiedIndex
+			if self.last_mod is None or self.last_mod < r.modifiedIndex:
+				self.last_mod = r.modifiedIndex
 		except EtcdKeyNotFound:
 			raise KeyError(path) from None
+		if self.optimistic:
+			await self._apply_local(r)
 		return r
 
+	async def _apply_local(self, r):
+		"""\
+			Optimistic mode: apply the result of our own write to the
+			tree now. Until the watcher sees that event, older events
+			for that key are ignored; see EtcWatcher._write().
+			"""
+		w = self._watcher
+		if w is None or r.modifiedIndex <= w.last_applied:
+			return # too late, the watcher has done it
+		if not r.key.startswith(w.extkey+'/'):
+			return
+		self._overlay[r.key] = r.modifiedIndex
+		try:
+			await self.task(w._write_local, r, _lane='watch')
+		except Exception:
+			logger.exception("Could not apply %s", r)
+			if self._overlay.get(r.key,None) == r.modifiedIndex:
+				del self._overlay[r.key]
+
 	async def run_with_wait(self, p,*a,**k):
 		res = await p(*a,**k)
 		if res is not None:
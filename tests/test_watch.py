@@ -30,12 +30,15 @@ logger = logging.getLogger(__name__)
 import pytest
 import etcd
 import time
+import pickle
+import json
 import asyncio
 from functools import partial
-from etcd_tree.node import EtcRoot,EtcDir,EtcValue,EtcInteger,EtcFloat,\
+from etcd_tree.node import EtcBase,EtcRoot,EtcDir,EtcValue,EtcInteger,EtcFloat,\
                            EtcXValue,EtcString,EtcBoolean,EtcAwaiter, \
-                           ReloadData,ReloadRecursive
-from etcd_tree.etcd import EtcTypes,WatchStopped
+                           ReloadData,ReloadRecursive,EtcPath,NotConverted, \
+                           Change,ChangeSet
+from etcd_tree.etcd import EtcTypes,WatchStopped,EtcWatcher
 
 from .util import cfg,client
 from unittest.mock import Mock
@@ -742,3 +745,1092 @@ async def do_typed(client,loop, subtyped,recursed):
     assert isinstance(v, Sub if subtyped else EtcDir)
 
     await w.close()
+
+@pytest.mark.run_loop
+async def test_subtype_cache(client):
+    """Type lookups are cached, but registering something resets that"""
+    types = EtcTypes()
+    types.register("*","one", cls=EtcInteger)
+    d=dict
+    t = client
+    await t._f(d(cache=d(a=d(one="1",two="2"),b=d(one="3",two="4"))))
+    w = await t.tree("/cache", immediate=True, static=True, types=types)
+    assert w['a'].subtype('one',dir=False) is EtcInteger
+    assert w['b'].subtype('one',dir=False) is EtcInteger
+    assert w['b'].subtype('two',dir=False) is EtcValue
+    assert w._subtype_cache
+    types.register("b","two", cls=EtcFloat)
+    assert w['a'].subtype('two',dir=False) is EtcValue
+    assert w['b'].subtype('two',dir=False) is EtcFloat
+    assert w['b'].subtype('b/two',dir=False) is EtcValue
+    await w.close()
+
+def test_types_matcher():
+    """Wildcard lookups, and re-matching after registrations change"""
+    types = EtcTypes()
+    types.register("**","three", cls=EtcInteger)
+    types.register("*","two","*", cls=EtcFloat)
+    assert types.lookup('one/two/three',dir=False) is EtcFloat
+    assert types.lookup('one/four/three',dir=False) is EtcInteger
+    assert types.lookup('one/two/:three',dir=False) is None
+    assert types.lookup('one/two/four/three',dir=False) is EtcInteger
+    m = types._matcher
+    assert types.lookup('eins/two/drei',dir=False) is EtcFloat
+    assert types._matcher is m
+    types.register("one","two","three", cls=EtcBoolean)
+    assert types.lookup('one/two/three',dir=False) is EtcBoolean
+    assert types._matcher is not m
+    assert types.lookup('eins/two/three',dir=False) is EtcFloat
+
+@pytest.mark.run_loop
+async def test_types_empty_element(client):
+    """Empty path elements are rejected with a ValueError"""
+    from etcd_tree.node import _types_pattern
+    with pytest.raises(ValueError):
+        _types_pattern(('a','','b'))
+    w = await client.tree("/empty")
+    for p in ("a//b", "a/", ('a','')):
+        with pytest.raises(ValueError):
+            w.subtype(p, dir=False)
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_batched_classify(client):
+    """Children which need data for typing are fetched in one go"""
+    class Picky(EtcDir):
+        def subtype(self,*path,pre=None,dir=None,**kw):
+            if len(path) == 1 and dir and pre is None:
+                raise ReloadData
+            return super().subtype(*path,pre=pre,dir=dir,**kw)
+    types = EtcTypes()
+    types.register("multi", cls=Picky)
+    d=dict
+    t = client
+    await t._f(d(batch=d(multi=d(a=d(x="1"),b=d(x="2"),c=d(x="3"),d="4"))))
+    w = await t.tree("/batch", immediate=None, static=True, types=types)
+
+    reads = []
+    t_read = t.read
+    async def counted_read(key,*a,**k):
+        reads.append(key)
+        return (await t_read(key,*a,**k))
+    t.read = counted_read
+    try:
+        m = await w['multi']
+    finally:
+        del t.read
+    assert isinstance(m,Picky)
+    assert len(reads) == 2, reads
+    assert set(m.keys()) == {'a','b','c','d'}
+    assert (await m['b'])['x'] == "2"
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_reclassify(client):
+    """Re-classifying after a type change doesn't read the data again"""
+    class Picky(EtcDir):
+        def subtype(self,*path,pre=None,dir=None,**kw):
+            if len(path) == 1 and dir and pre is None:
+                raise ReloadData
+            return super().subtype(*path,pre=pre,dir=dir,**kw)
+    class Registering(EtcString):
+        async def init(self):
+            types.register("multi","zz", cls=EtcString)
+            await super().init()
+    types = EtcTypes()
+    types.register("multi", cls=Picky)
+    types.register("multi","a", cls=Registering, pri=5)
+    d=dict
+    t = client
+    await t._f(d(recl=d(multi=d(a="1",b=d(x="2"),c=d(x="3")))))
+    w = await t.tree("/recl", immediate=None, static=True, types=types)
+
+    reads = []
+    t_read = t.read
+    async def counted_read(key,*a,**k):
+        reads.append(key)
+        return (await t_read(key,*a,**k))
+    t.read = counted_read
+    try:
+        m = await w['multi']
+    finally:
+        del t.read
+    assert isinstance(m.get('a',raw=True),Registering)
+    assert len(reads) == 2, reads
+    assert (await m['c'])['x'] == "3"
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_concurrent_load(client, loop):
+    """Sibling subdirectories can be read in parallel"""
+    class First(EtcDir):
+        async def init(self):
+            assert len(self.parent) == 1, self.parent._data
+            await super().init()
+    types = EtcTypes()
+    types.register("a0", cls=First, pri=1)
+    d=dict
+    t = client
+    await t._f(d(par=dict(("a%d"%i,d(b=d(c=str(i)))) for i in range(10))))
+
+    inflight = peak = 0
+    t_read = t.read
+    async def slow_read(key,*a,**k):
+        nonlocal inflight,peak
+        inflight += 1
+        peak = max(peak,inflight)
+        try:
+            await asyncio.sleep(0.02, loop=loop)
+            return (await t_read(key,*a,**k))
+        finally:
+            inflight -= 1
+    t.read = slow_read
+    try:
+        w = await t.tree("/par", immediate=False, static=True, types=types, concurrency=3)
+    finally:
+        del t.read
+    assert peak == 3, peak
+    assert isinstance(w['a0'],First)
+    assert w['a7']['b']['c'] == "7"
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_snapshot(client, tmpdir):
+    """A tree can be rebuilt from a snapshot and catch up from there"""
+    d=dict
+    t = client
+    snap = str(tmpdir.join("snap.json"))
+    await t._f(d(snap=d(one="1", two=d(three="3", four=d(five="5")))))
+    w = await t.tree("/snap", immediate=False)
+    await w.snapshot(snap)
+    await w.close()
+
+    mod = await t._f(d(snap=d(one="11", six="6")))
+
+    reads = []
+    c_read = t.client.read
+    async def counted_read(key,*a,**k):
+        if not k.get('wait',False):
+            reads.append((key,k.get('recursive',None)))
+        return (await c_read(key,*a,**k))
+    t.client.read = counted_read
+    try:
+        w = await t.tree("/snap", snapshot=snap)
+    finally:
+        del t.client.read
+    assert all(not r for k,r in reads), reads
+    assert w['two']['four']['five'] == "5"
+    await w.wait(mod, tasks=True)
+    assert w['one'] == "11"
+    assert w['six'] == "6"
+    await w.close()
+
+    with pytest.raises(ValueError):
+        await t.tree("/snap/two", snapshot=snap, static=True)
+    w = await t.tree("/snap", snapshot=str(tmpdir.join("nope.json")), static=True)
+    assert w['one'] == "11"
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_snapshot_floors(client, loop, tmpdir, monkeypatch):
+    """Subtrees read for a snapshot don't get older events applied after restoring"""
+    d=dict
+    t = client
+    snap = str(tmpdir.join("snap.json"))
+    await t._f(d(snfl=d(one="1", two=d(three="3"))))
+    w = await t.tree("/snfl", immediate=None)
+    assert type(w._data['two']) is EtcAwaiter
+
+    # changes the tree hasn't seen when the subtree is read
+    gate = asyncio.Event(loop=loop)
+    _batch = w._watcher._write_batch
+    async def held():
+        await gate.wait()
+        return (await _batch())
+    w._watcher._write_batch = held
+    await t._f(d(snfl=d(two=d(tmp="x"))))
+    r = await t.client.delete(t._extkey("/snfl/two/tmp"))
+    await w.snapshot(snap)
+    gate.set()
+    await w.close()
+    with open(snap) as f:
+        data = json.load(f)
+    assert data['index'] < r.modifiedIndex
+    assert data['floors'] == {t._extkey("/snfl/two"): data['floors'][t._extkey("/snfl/two")]}
+    assert data['floors'][t._extkey("/snfl/two")] >= r.modifiedIndex
+
+    seen = []
+    _write = EtcWatcher._write
+    async def watched(self, x, local=False):
+        res = await _write(self, x, local=local)
+        if x.key.endswith('/tmp'):
+            seen.append('tmp' in self.root()['two'])
+        return res
+    monkeypatch.setattr(EtcWatcher, '_write', watched)
+    w = await t.tree("/snfl", snapshot=snap)
+    mod = await t._f(d(snfl=d(two=d(three="33"))))
+    await w.wait(mod)
+    assert seen == [False,False]
+    assert w['two']['three'] == "33"
+    assert not w._watcher._floors
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_lazy_primitives(client):
+    """Nodes don't allocate events, monitor dicts or locks they don't use"""
+    d=dict
+    t = client
+    await t._f(d(lazy=d(a=d(b="1"),c="2")))
+    w = await t.tree("/lazy", static=True)
+    await w.wait(tasks=True)
+    v = w['a'].get('b', raw=True)
+    assert v._later_mon is None
+    assert (await v.ready)
+    assert v.is_ready
+    assert (await v.ready)
+    assert not hasattr(w,'_locks')
+    assert not hasattr(w['a'],'_locks')
+    assert not hasattr(t,'_locks')
+    await w.close()
+
+def test_path():
+    """EtcPath works like a tuple"""
+    p = EtcPath.of(('a','b'))
+    q = p+('c',)
+    assert q == ('a','b','c') and ('a','b','c') == q
+    assert q == EtcPath.of("a b c".split())
+    assert q != p and q != ('a','b','d')
+    assert hash(q) == hash(('a','b','c'))
+    assert q[-1] == 'c' and q[0] == 'a' and q[:-1] == ('a','b')
+    assert len(q) == 3 and list(q) == ['a','b','c']
+    assert ('x',)+q == ('x','a','b','c')
+    assert '/'.join(q) == 'a/b/c'
+    assert pickle.loads(pickle.dumps(q)) == q
+    assert q._parent is p
+
+@pytest.mark.run_loop
+async def test_lazy_value(client):
+    """Lazy values are decoded on first access"""
+    loads = []
+    class LazyInt(EtcInteger):
+        lazy = True
+        @classmethod
+        def _load(cls,value):
+            loads.append(value)
+            return super()._load(value)
+    types = EtcTypes()
+    types.register("*", cls=LazyInt)
+    d=dict
+    t = client
+    await t._f(d(lazyv=d(a="1",b="2",c="x")))
+    w = await t.tree("/lazyv", types=types)
+    assert loads == []
+    assert w['a'] == 1
+    assert w['a'] == 1
+    assert loads == ["1"]
+    assert w['c'] == NotConverted("x")
+
+    mod = await t._f(d(lazyv=d(a="3")))
+    await w.wait(mod)
+    assert loads == ["1","x"]
+    assert w['a'] == 3
+    assert loads == ["1","x","3"]
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_batch_events(client):
+    """Watcher events are applied in batches"""
+    d=dict
+    t = client
+    await t._f(d(batch2=d(x="0")))
+    w = await t.tree("/batch2")
+    seen = []
+    wb = w._watcher._write_batch
+    gate = asyncio.Event()
+    async def write_batch():
+        seen.append(w._watcher.last_seen)
+        await gate.wait() # let the events pile up
+        await wb()
+    w._watcher._write_batch = write_batch
+    mod = await t._f(d(batch2=dict(("k%d"%i,str(i)) for i in range(50))))
+    while w._watcher.last_read < mod:
+        await asyncio.sleep(0.01)
+    gate.set()
+    await w.wait(mod)
+    assert len(w) == 51
+    assert w['k49'] == "49"
+    assert w._watcher.last_seen == mod
+    assert 0 < len(seen) < 3, seen
+    assert seen == sorted(seen)
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_event_cache(client):
+    """Nodes which receive events are found via the watcher's cache"""
+    d=dict
+    t = client
+    await t._f(d(hot=d(a=d(b="0"))))
+    w = await t.tree("/hot")
+    wa = w._watcher
+    key = t._extkey(('hot','a','b'))
+    for i in range(1,4):
+        mod = await t._f(d(hot=d(a=d(b=str(i)))))
+        await w.wait(mod)
+        assert w['a']['b'] == str(i)
+        assert wa._nodes[key]() is w['a'].get('b',raw=True)
+    mod = await t.delete(key, _prefix=True)
+    await w.wait(mod.modifiedIndex)
+    assert key not in wa._nodes
+    assert 'b' not in w['a']
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_resync(client):
+    """A watcher that lost events re-reads the tree and applies the differences"""
+    d=dict
+    t = client
+    await t._f(d(resync=d(a="1",b="2",c=d(d="3",e="4"))))
+    w = await t.tree("/resync", static=True)
+    await t._f(d(resync=d(a="11",f="6",c=d(e="44",g=d(h="8")))))
+    await t.delete("/resync/b")
+    await t.delete("/resync/c/d")
+
+    # attach a watcher which missed all of that
+    xkey = t._extkey(('resync',))
+    res = await t.client.read(xkey, recursive=True)
+    wa = EtcWatcher(t, xkey, seq=res.etcd_index-1)
+    w._watcher = wa
+    wa._set_root(w)
+    upd = []
+    mon = w['c'].add_monitor(lambda x: upd.append((set(x.added),set(x.deleted))))
+    wa.last_read = res.etcd_index
+    wa._queue(res)
+    await w.wait(res.etcd_index)
+
+    assert w['a'] == "11"
+    assert 'b' not in w
+    assert w['f'] == "6"
+    assert w['c']['e'] == "44"
+    assert 'd' not in w['c']
+    assert w['c']['g']['h'] == "8"
+    await w['c'].ready
+    assert 'g' in upd[-1][0], upd
+    assert upd[-1][1] == {'d'}, upd
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_shared_watch(client, tmpdir):
+    """Trees on overlapping prefixes share one etcd watch"""
+    d=dict
+    t = client
+    snap = str(tmpdir.join("snap.json"))
+    await t._f(d(share=d(sub=d(x="0"),y="0")))
+    w2 = await t.tree("/share/sub")
+    w1 = await t.tree("/share")
+    assert list(t._watches) == [t._extkey(('share',))]
+    assert w1._watcher._shared is w2._watcher._shared
+
+    mod = await t._f(d(share=d(y="1",sub=d(x="1"))))
+    await w1.wait(mod)
+    await w2.wait(mod)
+    assert w1['sub']['x'] == "1"
+    assert w1['y'] == "1"
+    assert w2['x'] == "1"
+
+    # a watcher which starts from an older index catches up
+    await w2.snapshot(snap)
+    await w2.close()
+    mod = await t._f(d(share=d(sub=d(x="2",z="3"))))
+    await w1.wait(mod)
+    w3 = await t.tree("/share/sub", snapshot=snap)
+    await w3.wait(mod)
+    assert w3['x'] == "2"
+    assert w3['z'] == "3"
+    assert len(t._watches) == 1
+    await w3.close()
+    await w1.close()
+    assert not t._watches
+
+@pytest.mark.run_loop
+async def test_sync_waiters(client, loop):
+    """sync() callers are released in index order, once"""
+    d=dict
+    t = client
+    await t._f(d(waiters=d(x="0")))
+    w = await t.tree("/waiters")
+    wa = w._watcher
+    base = wa.last_seen
+    mods = [base+i+1 for i in range(5)]
+    done = []
+    async def waiter(m):
+        await wa.sync(m)
+        assert wa.last_seen >= m
+        done.append(m)
+    waiting = [asyncio.ensure_future(waiter(m), loop=loop) for m in reversed(mods)]
+    await asyncio.sleep(0.01, loop=loop)
+    assert len(wa._waiters) == 5
+    for i in range(5):
+        await t._f(d(waiters=d(x=str(i+1))))
+    await asyncio.gather(*waiting, loop=loop)
+    assert done == mods
+    assert not wa._waiters
+    await w.close()
+    with pytest.raises(WatchStopped):
+        await wa.sync(mods[-1]+1)
+
+@pytest.mark.run_loop
+async def test_update_timers(client, loop):
+    """update timers share the root's heap and a single loop handle"""
+    d=dict
+    t = client
+    await t._f(d(timers=d(x="0")))
+    w = await t.tree("/timers", update_delay=0.05, max_update_delay=0.5)
+    fired = []
+    n = len(w._timers)
+    ts = [w._call_later(0.01*(i%5+1), fired.append, i) for i in range(50)]
+    h = w._timer_handle
+    assert h is not None
+    assert len(w._timers) == n+50
+    for i in range(0,50,2):
+        ts[i].cancel()
+    # postponing keeps the heap entry and the loop handle
+    ts[1].reset(0.1, 'late')
+    assert len(w._timers) == n+50
+    assert w._timer_handle is h
+    await asyncio.sleep(0.2, loop=loop)
+    assert fired[-1] == 'late'
+    assert sorted(fired[:-1]) == list(range(3,50,2))
+
+    # updates still get delivered
+    seen = []
+    mon = w.add_monitor(lambda x: seen.append(x['x']))
+    for i in range(5):
+        await t._f(d(timers=d(x=str(i+1))))
+    await w.wait(tasks=True)
+    await asyncio.sleep(0.2, loop=loop)
+    assert seen[-1] == "5"
+    await w.close()
+    assert w._timer_handle is None
+
+@pytest.mark.run_loop
+async def test_dirty_children(client, loop, monkeypatch):
+    """an update pass only visits children that changed"""
+    d=dict
+    t = client
+    await t._f(d(dirty=d(("v%d"%i,str(i)) for i in range(200))))
+    w = await t.tree("/dirty", update_delay=0.05, max_update_delay=0.2)
+    await w.ready
+    assert not w._dirty
+    order = []
+    mv = w.get('v7', raw=True).add_monitor(lambda x: order.append(x.name))
+    mw = w.add_monitor(lambda x: order.append('root'))
+    order.clear()
+    stepped = []
+    step = EtcBase._run_update_step
+    async def counted(self):
+        stepped.append(self.name)
+        await step(self)
+    monkeypatch.setattr(EtcBase, '_run_update_step', counted)
+    mod = await t._f(d(dirty=d(v7="x")))
+    await w.wait(mod)
+    await w.ready
+    assert order == ['v7','root']
+    assert sorted(stepped) == ['', 'v7']
+    assert not w._dirty
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_changeset(client, loop):
+    """change monitors get old and new values"""
+    d=dict
+    t = client
+    await t._f(d(chg=d(a="1",b="2",c="3",sub=d(x="y"))))
+    w = await t.tree("/chg", update_delay=0.05, max_update_delay=0.2)
+    await w.ready
+    got = []
+    mon = w.add_monitor(lambda x,c: got.append(c), changes=True)
+    assert set(got[0].added) == {'a','b','c','sub'}
+    assert got[0].added['a'] == Change(None,"1",w.get('a',raw=True)._seq)
+    got.clear()
+
+    await t._f(d(chg=d(a="11")))
+    await t._f(d(chg=d(a="111",d="4")))
+    mod = await t.delete("/chg/b")
+    await w.wait(mod.modifiedIndex)
+    await w.ready
+    c, = got
+    assert isinstance(c, ChangeSet)
+    assert c.changed == {'a': Change("1","111",w.get('a',raw=True)._seq)}
+    assert c.added == {'d': Change(None,"4",w.get('d',raw=True)._seq)}
+    assert c.deleted == {'b': Change("2",None,mod.modifiedIndex)}
+    assert w.changes is c
+
+    # plain monitors don't pay for it
+    mon.cancel()
+    mod = await t._f(d(chg=d(c="33")))
+    await w.wait(mod)
+    await w.ready
+    await w.close()
+    assert w._changed is None
+
+@pytest.mark.run_loop
+async def test_subscribe(client, loop):
+    """one subscription covers many nodes"""
+    d=dict
+    t = client
+    await t._f(d(subs=d(hosts=d(a=d(status="up")))))
+    w = await t.tree("/subs")
+    got = []
+    from etcd_tree import node as _node
+    gen = _node._types_gen
+    s1 = w.subscribe("hosts/*/status", lambda p,x: got.append(p))
+    deep = []
+    async def adeep(p,x):
+        deep.append((p,x.action))
+    s2 = w.subscribe(('hosts','**'), adeep)
+    mod = await t._f(d(subs=d(hosts=d(
+        a=d(status="down",load="1"),
+        b=d(status="up"),
+        ), other=d(status="x"))))
+    await w.wait(mod)
+    assert sorted(got) == [('hosts','a','status'),('hosts','b','status')]
+    assert ('hosts','a','load') in set(p for p,a in deep)
+    assert not any(p[0] == 'other' for p,a in deep)
+
+    s1.cancel()
+    r = await t.delete("/subs/hosts/b/status")
+    await w.wait(r.modifiedIndex)
+    assert len(got) == 2
+    assert deep[-1] == (('hosts','b','status'),'delete')
+    s2.cancel()
+    assert not w._sub_cbs
+    assert not w._subs.nodes # no leftover patterns
+    assert not w._subs.names
+    assert _node._types_gen == gen # typing is unaffected
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_change_stream(client, loop):
+    """changes() streams events through a bounded buffer"""
+    d=dict
+    t = client
+    await t._f(d(strm=d(a=d(x="0"),b=d(y="0"))))
+    w = await t.tree("/strm")
+    since = w._watcher.last_seen
+    first = await t._f(d(strm=d(a=d(x="1"))))
+    await w.wait(first)
+
+    every = w.changes(since=since)
+    only_a = w.changes(prefix="a")
+    dropping = w.changes(maxlen=2)
+    collapsing = w.changes(maxlen=2, overflow='collapse')
+    with pytest.raises(ValueError):
+        w.changes(overflow='nope')
+
+    for i in range(2,5):
+        mod = await t._f(d(strm=d(a=d(x=str(i)),b=d(y=str(i)))))
+    await w.wait(mod)
+
+    # replayed from etcd's history, then live
+    ev = await every.__anext__()
+    assert (ev.path,ev.new,ev.seq) == (('a','x'),"1",first)
+    ev = await every.__anext__()
+    assert (ev.path,ev.new) == (('a','x'),"2")
+
+    res = []
+    for i in range(3):
+        res.append((await only_a.__anext__()).new)
+    assert res == ["2","3","4"]
+    assert not only_a._buf
+
+    assert dropping.dropped == 4
+    evs = [await dropping.__anext__() for i in range(2)]
+    assert [(e.path,e.new) for e in evs] == [(('a','x'),"4"),(('b','y'),"4")]
+
+    assert collapsing.dropped == 0
+    evs = [await collapsing.__anext__() for i in range(2)]
+    assert sorted((e.path,e.new) for e in evs) == [(('a','x'),"4"),(('b','y'),"4")]
+
+    blocking = w.changes(maxlen=1, overflow='block')
+    async def consume():
+        res = []
+        async for ev in blocking:
+            res.append(ev.new)
+        return res
+    mod = await t._f(d(strm=d(a=d(x="5"),b=d(y="5"))))
+    await asyncio.sleep(0.1, loop=loop)
+    assert w._watcher.last_seen < mod # blocked
+    c = asyncio.ensure_future(consume(), loop=loop)
+    await w.wait(mod)
+
+    # etcd's history doesn't reach back far enough
+    async def cleared(*a,**k):
+        raise etcd.EtcdEventIndexCleared("gone")
+    old = w.changes(since=since)
+    mod = await t._f(d(strm=d(a=d(x="6"))))
+    await w.wait(mod)
+    w._conn.client.read = cleared
+    with pytest.raises(etcd.EtcdEventIndexCleared):
+        await old.__anext__()
+    assert old.closed
+
+    # ... or it does not answer
+    async def stalled(*a,**k):
+        await asyncio.sleep(1, loop=loop)
+    old = w.changes(since=since)
+    old.backfill_timeout = 0.05
+    w._conn.client.read = stalled
+    with pytest.raises(asyncio.TimeoutError):
+        await old.__anext__()
+    assert old.closed
+    with pytest.raises(asyncio.TimeoutError):
+        await old.__anext__()
+    del w._conn.client.read
+    await w.close()
+    assert (await c) == ["5","5","6"]
+
+@pytest.mark.run_loop
+async def test_task_runner(client, loop):
+    """jobs report results and errors; wait(tasks=True) is a barrier"""
+    d=dict
+    t = client
+    await t._f(d(runner=d(x="0")))
+    w = await t.tree("/runner", update_delay=0.05, max_update_delay=0.2)
+    done = []
+    async def job(i):
+        await asyncio.sleep(0.001*(i%7), loop=loop)
+        done.append(i)
+        return i
+    fs = [w.task(job,i) for i in range(2000)]
+    assert w._jobs >= 2000
+    await w.wait(tasks=True)
+    assert not w._jobs
+    assert sorted(done) == list(range(2000))
+    assert [f.result() for f in fs] == list(range(2000))
+
+    async def fail():
+        raise RuntimeError("bah")
+    with pytest.raises(RuntimeError):
+        await w.task(fail)
+    w.task(fail, _die=True)
+    with pytest.raises(RuntimeError):
+        await w.wait(tasks=True)
+
+    # a slow job's result times out, but the job itself continues
+    # while the tree makes progress
+    ran = []
+    async def slow():
+        await asyncio.sleep(0.5, loop=loop)
+        ran.append(1)
+    f = w.task(slow)
+    for i in range(8):
+        await w.task(asyncio.sleep, 0.1, loop=loop)
+    with pytest.raises(asyncio.CancelledError):
+        await f
+    assert ran == [1]
+
+    # a stalled tree gets its jobs cancelled
+    w.task(asyncio.sleep, 10, loop=loop, _die=True)
+    with pytest.raises(asyncio.CancelledError):
+        await w.wait(tasks=True)
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_task_lanes(client, loop):
+    """task() lanes: strict priority, concurrency caps, queue limits"""
+    d=dict
+    t = client
+    await t._f(d(lanes=d(x="0")))
+    w = await t.tree("/lanes", lanes=d(watch=d(pri=0, strict=True), write=d(pri=3, limit=2, depth=3)))
+    gate = asyncio.Event()
+    running = []
+    peak = [0]
+    async def held():
+        await gate.wait()
+    async def job(i):
+        running.append(i)
+        peak[0] = max(peak[0],len(running))
+        await asyncio.sleep(0.01, loop=loop)
+        running.remove(i)
+        return i
+    h = w.task(held, _lane='watch')
+    fs = [w.task(job,i, _lane='write') for i in range(3)]
+    with pytest.raises(asyncio.QueueFull):
+        w.task(job,9, _lane='write')
+    u = w.task(asyncio.sleep, 0, 10, loop=loop, _lane='update')
+    await asyncio.sleep(0.05, loop=loop)
+    # held back by the strict watcher lane
+    assert not running
+    assert not fs[0].done()
+    assert not u.done()
+    gate.set()
+    assert [await f for f in fs] == [0,1,2]
+    assert (await u) == 10
+    assert peak[0] == 2
+    await h
+    await w.close()
+
+    # by default, watcher jobs may wait for other lanes
+    w = await t.tree("/lanes")
+    async def cb(p,x):
+        await w.task(job,p[-1], _lane='write')
+    s = w.subscribe("x", cb)
+    mod = await t._f(d(lanes=d(x="1")))
+    await asyncio.wait_for(w.wait(mod), 1, loop=loop)
+    s.cancel()
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_pipelined_set(client, loop):
+    """set() and update() with a mapping write concurrently"""
+    d=dict
+    t = client
+    await t._f(d(pipe=d(x="0")))
+    w = await t.tree("/pipe")
+    inflight = [0,0]
+    mods = []
+    _set = w._set
+    async def counted(*a,**k):
+        inflight[0] += 1
+        inflight[1] = max(inflight)
+        try:
+            r = await _set(*a,**k)
+        finally:
+            inflight[0] -= 1
+        mods.append(r.modifiedIndex)
+        return r
+    w._set = counted
+    data = d(("d%d"%i, d(("v%d"%j,str(j)) for j in range(10))) for i in range(20))
+    data['empty'] = {}
+    mod = await w.set('blob', data, window=8)
+    assert mod == max(mods)
+    assert 1 < inflight[1] <= 8
+    assert len(mods) == 201
+    assert w['blob']['d19']['v9'] == "9"
+    assert len(w['blob']['empty']) == 0
+
+    # bad data is rejected before anything is written
+    del mods[:]
+    with pytest.raises(AssertionError):
+        await w.set('bad', d(a="1",b=d(c=2)))
+    assert not mods
+
+    # ... including values of existing nodes
+    with pytest.raises(AssertionError):
+        await w.set('blob', d(d0=d(v0="new"),d1=d(v1=1)))
+    assert not mods
+    assert w['blob']['d0']['v0'] == "0"
+
+    del mods[:]
+    inflight[1] = 0
+    mod = await w.update(x="1", blob=d(d0=d(v0="x"),d1=d(v1="y"),d2=d(v2="z")), _window=1)
+    assert mod == max(mods)
+    assert inflight[1] == 1
+    assert len(mods) == 4
+    assert w['x'] == "1"
+    assert w['blob']['d1']['v1'] == "y"
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_write_coalescing(client, loop):
+    """repeated assignments to a key collapse to the latest value"""
+    d=dict
+    t = client
+    await t._f(d(coal=d(x="0")))
+    w = await t.tree("/coal")
+    writes = []
+    _set = w._set
+    async def counted(path,value,**k):
+        writes.append((tuple(path),value,k.get('index')))
+        await asyncio.sleep(0.01, loop=loop)
+        return (await _set(path,value,**k))
+    w._set = counted
+    x = w.get('x', raw=True)
+    seq = x._seq
+    for i in range(50):
+        x.value = str(i)
+        w['y'] = str(i)
+    await asyncio.sleep(0.001, loop=loop)
+    # more assignments while the first write is in flight
+    for i in range(50,60):
+        x.value = str(i)
+    await w.wait(tasks=True)
+    xw = [v for v in writes if v[0][-1] == 'x']
+    assert [v for p,v,i in xw] == ["49","59"]
+    assert xw[0][2] == seq
+    assert xw[1][2] > seq # the first write's index, not the stale one
+    assert [v for p,v,i in writes if p[-1] == 'y'] == ["49"]
+    assert w['x'] == "59"
+    assert w['y'] == "49"
+
+    # a deletion isn't overtaken by an earlier assignment
+    x = w.get('y', raw=True)
+    x.value = "gone"
+    del x.value
+    await w.wait(tasks=True)
+    assert 'y' not in w
+    assert not w._wbuf
+    await w.close()
+
+    # a full write lane delays writes instead of losing them
+    w = await t.tree("/coal", lanes=d(write=d(pri=3, limit=1, depth=0)))
+    for i in range(5):
+        w['k'+str(i)] = str(i)
+    await w.wait(tasks=True)
+    assert not w._wbuf
+    assert [w['k'+str(i)] for i in range(5)] == ["0","1","2","3","4"]
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_optimistic(client, loop):
+    """our own writes are visible before the watcher catches up"""
+    d=dict
+    t = client
+    await t._f(d(opt=d(x="0",y="1",sub=d(a="1"))))
+    w = await t.tree("/opt", optimistic=True, update_delay=0.05)
+    seen = []
+    def mon(n):
+        seen.append(n.get('x',None))
+    m = w.add_monitor(mon)
+
+    # hold the watcher back
+    gate = asyncio.Event(loop=loop)
+    _batch = w._watcher._write_batch
+    async def held():
+        await gate.wait()
+        return (await _batch())
+    w._watcher._write_batch = held
+
+    # an older deletion of the parent doesn't lose our write
+    await t.client.delete(client._extkey("/opt/sub"), dir=True, recursive=True)
+    await w['sub'].set('b', "2", sync=False)
+    assert w['sub']['b'] == "2"
+
+    await w.set('x', "2", sync=False)
+    assert w['x'] == "2"
+    await w.delete('y', sync=False)
+    assert 'y' not in w
+    assert len(w._overlay) == 3
+
+    # somebody else overrides our write
+    r = await t.client.write(client._extkey("/opt/x"), "3")
+    gate.set()
+    await w.wait(r.modifiedIndex)
+    assert w['x'] == "3"
+    assert 'y' not in w
+    assert 'a' not in w['sub']
+    assert w['sub']['b'] == "2"
+    assert not w._overlay
+    await asyncio.sleep(0.2, loop=loop)
+    assert seen[-1] == "3"
+
+    # a failed local update doesn't stop the watcher
+    _write = w._watcher._write
+    async def broken(x, local=False):
+        if local:
+            raise RuntimeError("oops")
+        return (await _write(x, local=local))
+    w._watcher._write = broken
+    mod = await w.set('x', "4", sync=False)
+    assert not w._overlay
+    await w.wait(mod)
+    assert w['x'] == "4"
+    assert w.running
+    m.cancel()
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_replace(client, loop):
+    """replace() only writes what differs"""
+    d=dict
+    t = client
+    await t._f(d(repl=d(a="1",b="2",c=d(x="1",y="2"),e="5",f=d(z="z"))))
+    w = await t.tree("/repl")
+    writes = []
+    _set,_delete = w._set,w._delete
+    async def c_set(path,value,**k):
+        writes.append(('set',path[-1],k.get('index')))
+        return (await _set(path,value,**k))
+    async def c_delete(path,**k):
+        writes.append(('del',path[-1],k.get('index')))
+        return (await _delete(path,**k))
+    w._set,w._delete = c_set,c_delete
+    reads = []
+    _get = w._conn.get
+    async def c_get(*a,**k):
+        reads.append(a)
+        return (await _get(*a,**k))
+    w._conn.get = c_get
+
+    seq_a = w.get('a',raw=True)._seq
+    mod = await w.replace(d(a="11",c=d(x="1",y="22",n="new"),e=d(q="q"),f="f",g=d()))
+    assert (await t._d("/repl")) == d(a="11",c=d(x="1",y="22",n="new"),e=d(q="q"),f="f",g=d())
+    assert w['a'] == "11"
+    assert 'b' not in w
+    assert w["c"]["n"] == "new"
+    assert (await w["e"])["q"] == "q"
+    assert w['f'] == "f"
+    assert mod == w.last_mod
+    assert ('set','a',seq_a) in writes
+    assert {(a,b) for a,b,c in writes} == {('set','a'),('del','b'),('set','y'),('set','n'),
+        ('del','e'),('set','q'),('del','f'),('set','f'),('set','g')}
+    assert not reads
+
+    # nothing to do
+    writes.clear()
+    assert await w.replace(d(a="11",c=d(x="1",y="22",n="new"),e=d(q="q"),f="f",g=d())) is None
+    assert not writes
+
+    # bad values are rejected before anything is written
+    with pytest.raises(AssertionError):
+        await w.replace(d(a=11,c=d(x="1",y="22",n="new"),e=d(q="q"),f="f",g=d()))
+    with pytest.raises(AssertionError):
+        await w.replace(d(a="12",c=d(x="1",y="22",n="new"),e=d(q="q"),f=d(z=2),g=d()))
+    assert not writes
+
+    # a concurrent change is not clobbered
+    gate = asyncio.Event(loop=loop)
+    _write = w._watcher._write
+    async def held(x, **k):
+        await gate.wait()
+        return (await _write(x, **k))
+    w._watcher._write = held
+    await t._f(d(repl=d(a="x")))
+    with pytest.raises(etcd.EtcdCompareFailed):
+        await w.replace(d(a="y",c=d(x="1",y="22",n="new"),e=d(q="q"),f="f",g=d()))
+    gate.set()
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_resync_reader(client, loop, monkeypatch):
+    """The shared reader re-reads its trees when etcd's history is gone"""
+    d=dict
+    t = client
+    await t._f(d(clr=d(a="1",sub=d(b="2"))))
+    w = await t.tree("/clr")
+    ws = await t.tree("/clr/sub")
+    sw = w._watcher._shared
+    assert ws._watcher._shared is sw
+    st = w.changes()
+    r = sw.stop()
+    with pytest.raises(asyncio.CancelledError):
+        await r
+
+    # changes which the reader doesn't see
+    await t._f(d(clr=d(a="11")))
+    mod = (await t.client.delete(t._extkey('/clr/sub'), dir=True, recursive=True)).modifiedIndex
+
+    import etcd_tree.etcd as etcd_mod
+    Client = etcd_mod.Client
+    first = [True]
+    def cleared(*a,**k):
+        c = Client(*a,**k)
+        watch = c.eternal_watch
+        async def eternal_watch(*a,**k):
+            if first[0]:
+                first[0] = False
+                raise etcd.EtcdEventIndexCleared("gone")
+            return (await watch(*a,**k))
+        c.eternal_watch = eternal_watch
+        return c
+    monkeypatch.setattr(etcd_mod, 'Client', cleared)
+    sw._start()
+
+    await w.wait(mod)
+    assert w['a'] == "11"
+    assert 'sub' not in w
+    assert w.running
+    # the stream can't report what the re-read changed
+    with pytest.raises(etcd.EtcdEventIndexCleared):
+        await st.__anext__()
+    # the tree whose root vanished stops, the other one doesn't
+    assert not ws.running
+    with pytest.raises(WatchStopped):
+        await ws.wait(mod)
+    await ws.close()
+    mod = await t._f(d(clr=d(a="111")))
+    await w.wait(mod)
+    assert w['a'] == "111"
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_late_kill(client, loop):
+    """A closed tree's finalizer doesn't unregister a newer tree on the same path"""
+    d=dict
+    t = client
+    await t._f(d(late=d(x="1")))
+    w1 = await t.tree("/late")
+    await w1.close()
+    w2 = await t.tree("/late")
+    assert w1 == w2 # same path
+    w1._kill() # as by a delayed __del__
+    assert w2 in t._trees
+    assert any(x is w2 for x in t._trees)
+    await w2.close()
+
+@pytest.mark.run_loop
+async def test_optimistic_late(client, loop):
+    """A local apply which the watcher overtook is dropped"""
+    d=dict
+    t = client
+    await t._f(d(optl=d(x="0")))
+    w = await t.tree("/optl", optimistic=True)
+
+    # delay the local apply
+    gate = asyncio.Event(loop=loop)
+    task = w.task
+    def held_task(p,*a,**k):
+        if getattr(p,'__name__',None) == '_write_local':
+            async def held(*a):
+                await gate.wait()
+                return (await p(*a))
+            return task(held,*a,**k)
+        return task(p,*a,**k)
+    w.task = held_task
+
+    f = asyncio.ensure_future(w.set('x', "2", sync=False), loop=loop)
+    await asyncio.sleep(0.05, loop=loop)
+    assert not f.done()
+    r = await t.client.delete(client._extkey("/optl/x"))
+    await w.wait(r.modifiedIndex)
+    assert 'x' not in w
+    gate.set()
+    await f
+    assert 'x' not in w
+    del w.task
+    await w.close()
+
+@pytest.mark.run_loop
+async def test_snapshot_floor_parent(client, loop, tmpdir):
+    """A replayed delete of a parent doesn't lose a subtree read later"""
+    d=dict
+    t = client
+    snap = str(tmpdir.join("snap.json"))
+    await t._f(d(snfp=d(p=d(x="1", a=d(c="1")))))
+    w = await t.tree("/snfp", immediate=None)
+    p = await w._data['p'].load()
+    assert type(p._data['a']) is EtcAwaiter
+
+    gate = asyncio.Event(loop=loop)
+    _batch = w._watcher._write_batch
+    async def held():
+        await gate.wait()
+        return (await _batch())
+    w._watcher._write_batch = held
+    r = await t.client.delete(t._extkey("/snfp/p"), recursive=True)
+    await t._f(d(snfp=d(p=d(a=d(c="2")))))
+    await w.snapshot(snap)
+    gate.set()
+    await w.close()
+    with open(snap) as f:
+        data = json.load(f)
+    assert data['index'] < r.modifiedIndex
+    assert t._extkey("/snfp/p/a") in data['floors']
+
+    w = await t.tree("/snfp", snapshot=snap)
+    mod = await t._f(d(snfp=d(y="1")))
+    await w.wait(mod)
+    assert 'x' not in w['p']
+    assert w['p']['a']['c'] == "2"
+    assert not w._watcher._floors
+    await w.close()